@@ -1,5 +1,13 @@
-from .mpd import _calc_mpd_core, calculate_mpd
-from .tpa import _calc_tpa_core, calculate_tpa
-from .profile_info import profile_info
-from .filtering import mpd_butterworth, mpd_butterworth_high, mpd_butterworth_low, envelope, interpolate_dropouts, _create_dropouts_cond
-from .utils import iter_intervals_by_true, iter_intervals_by_length
+from .mpd import _calc_mpd_core, calculate_mpd, iter_calculate_mpd, calculate_mpd_sliding
+from .tpa import _calc_tpa_core, calculate_tpa, iter_calculate_tpa
+from .texture import calculate_texture, texture_dtype, TEXTURE_METRICS
+from .pipeline import Pipeline
+from .index import MPDIndex
+from .storage import write_profile, open_profile, ProfileWriter, ProfileFile
+from .ingest import iter_read_text, read_text, ingest_text
+from .gps import GPSChainage, calc_curvature_radi, iter_curvature_radius
+from .spatial import SpatialIndex, index_ranges, interval_ranges
+from .profile_info import profile_info, profile_statistics, profile_statistics_chunked, ProfileStatistics
+from .filtering import mpd_butterworth, mpd_butterworth_high, mpd_butterworth_low, envelope, envelope_windowed, interpolate_dropouts, _create_dropouts_cond, ButterworthFilter, MPDButterworthFilter
+from .utils import iter_intervals_by_true, iter_intervals_by_length, segment_boundaries, sliding_segment_boundaries, find_runs, SegmentationCache, segmentation_cache, evaluation_counts
+from .parallel import map_segments
@@ -1,29 +1,124 @@
-from scipy.signal import butter, lfilter
-from scipy.interpolate import interp1d
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from heapq import heappop, heappush
+from scipy.signal import butter, sosfilt
 import numpy as np
 
-from .utils import _epsilon
+from .utils import _epsilon, _true_runs, _true_runs_2d
 
 mpd_butterworth_order = 2
 TRUNCATE_THRESHOLD_MM = 5/1000 + _epsilon # 5/1000 = 5 mm
+MPD_HIGHPASS_CUTOFF = 140/1000 # 140 mm normalized to m
+MPD_LOWPASS_CUTOFF = 3/1000 # 3 mm normalized to m. TODO find  cutoff-freq in ISO standard.
+FLOAT32_FILTER_BLOCKSIZE = 2**16 # Points filtered in float64 at a time for float32 profiles
 
 def mpd_butterworth(x, y):
+    if np.shape(y)[-1] == 0:
+        return np.asarray(y) # No sampling rate to design the filters from
     sampling_rate = np.mean(np.diff(x))
-    y = mpd_butterworth_high(y, sampling_rate)
-    return mpd_butterworth_low(y, sampling_rate)
+    return MPDButterworthFilter(sampling_rate)(y)
 
 def mpd_butterworth_high(z, sampling_rate):
-    cutoff_freq = 140/1000 # 140 mm normalized to m
-    return butterworth(z, mpd_butterworth_order, cutoff_freq, sampling_rate, 'highpass')
+    return ButterworthFilter(mpd_butterworth_order, MPD_HIGHPASS_CUTOFF, sampling_rate, 'highpass')(z)
 
 def mpd_butterworth_low(z, sampling_rate):
-    cutoff_freq = 3/1000 # 3 mm normalized to m
-    return butterworth(z, mpd_butterworth_order, cutoff_freq, sampling_rate, 'lowpass') # TODO find  cutoff-freq in ISO standard.
+    return ButterworthFilter(mpd_butterworth_order, MPD_LOWPASS_CUTOFF, sampling_rate, 'lowpass')(z)
 
 def butterworth(z, order, cutoff_frequency, sampling_rate, btype): # sampling rate in [samples/mm]
+    return ButterworthFilter(order, cutoff_frequency, sampling_rate, btype)(z)
+
+@lru_cache(maxsize=64)
+def _butterworth_sos(order, cutoff_frequency, sampling_rate, btype):
     normalized_frequency = 2 / (cutoff_frequency / sampling_rate) # [half-cycles/sample]
-    a, b = butter(order, normalized_frequency, btype=btype)
-    return lfilter(a, b, z)
+    return butter(order, normalized_frequency, btype=btype, output='sos')
+
+
+class ButterworthFilter:
+    """
+    Butterworth filter in second-order sections (SOS) form that keeps its internal state between calls, i.e., filtering
+    a profile block by block gives the same result as filtering it in one call. The filter design is cached per
+    `(order, cutoff_frequency, sampling_rate, btype)`.
+
+    :param order: Filter order.
+    :param cutoff_frequency: Cutoff wavelength in meters.
+    :param sampling_rate: Distance between measurements in meters.
+    :param btype: '*highpass*' or '*lowpass*'.
+    """
+    def __init__(self, order, cutoff_frequency, sampling_rate, btype):
+        self.sos = _butterworth_sos(order, cutoff_frequency, sampling_rate, btype)
+        self.state = None
+
+    def __call__(self, z):
+        """
+        Filter the next block `z` of the profile (along the last axis).
+        """
+        z = np.asarray(z)
+        if z.shape[-1] == 0:
+            return z # sosfilt does not accept empty input, and the state is unchanged.
+        if self.state is None:
+            self.state = np.zeros((len(self.sos),) + z.shape[:-1] + (2,))
+        if z.dtype != np.float32:
+            z, self.state = sosfilt(self.sos, z, zi=self.state)
+            return z
+        # The poles of the high-pass filter are too close to 1 for float32 coefficients, so a float32 profile is
+        # filtered in float64 a part at a time and only the output is stored as float32.
+        filtered = np.empty_like(z)
+        for start in range(0, z.shape[-1], FLOAT32_FILTER_BLOCKSIZE):
+            part = slice(start, start + FLOAT32_FILTER_BLOCKSIZE)
+            filtered[..., part], self.state = sosfilt(self.sos, z[..., part], zi=self.state)
+        return filtered
+
+    def reset(self):
+        """
+        Reset the filter to its initial (rest) state, e.g., before filtering a new profile.
+        """
+        self.state = None
+
+
+class MPDButterworthFilter(ButterworthFilter):
+    """
+    The high- and low-pass Butterworth filter pair from ISO 13473-1 used by the '*butterworth*' MPD method as one
+    stateful filter (see :class:`.ButterworthFilter`).
+
+    :param sampling_rate: Distance between measurements in meters.
+    :param fused: If `True` both filters are applied in a single pass over each block as one cascade of second-order
+        sections. Otherwise the high-pass output is materialized before applying the low-pass filter. The results are
+        identical for float64 profiles. For float32 profiles the unfused filter rounds the high-pass output to float32,
+        so the results agree within the float32 accuracy documented in the API reference.
+    """
+    def __init__(self, sampling_rate, fused=True):
+        self.filters = [
+                ButterworthFilter(mpd_butterworth_order, MPD_HIGHPASS_CUTOFF, sampling_rate, 'highpass'),
+                ButterworthFilter(mpd_butterworth_order, MPD_LOWPASS_CUTOFF, sampling_rate, 'lowpass'),
+                ]
+        self.fused = fused
+        self.sos = np.concatenate([f.sos for f in self.filters])
+        self.state = None
+
+    def __call__(self, z):
+        if self.fused:
+            return super().__call__(z)
+        for f in self.filters:
+            z = f(z)
+        return z
+
+    def reset(self):
+        super().reset()
+        for f in self.filters:
+            f.reset()
+
+def _mpd_butterworth_stream(sampling_rate=None):
+    """
+    Same as :func:`.mpd_butterworth` for a profile given block by block. Returns a function `(x, y) -> y_filtered` that
+    keeps the filter state between calls. If `sampling_rate` is `None` it is estimated from the first block.
+    """
+    filters = []
+
+    def apply(x, y):
+        if not filters:
+            filters.append(MPDButterworthFilter(np.mean(np.diff(x)) if sampling_rate is None else sampling_rate))
+        return filters[0](y)
+    return apply
 
 def _create_dropouts_cond(y, criteria):
     if np.isnan(criteria):
@@ -32,67 +127,158 @@ def _create_dropouts_cond(y, criteria):
         drop_outs = y == criteria
     return drop_outs
 
-def _find_invalid_endpoint_intervals(y):
-    for n, val in enumerate(y):
-        if val: continue
-        else: return n
+def _fill_endpoints(x, y, rows, starts, ends, truncated):
+    # Leading and trailing dropouts are truncated if they are longer than TRUNCATE_THRESHOLD_MM and otherwise replaced
+    # by the nearest valid value. If there is only one invalid point the distance will be 0 thus no truncation. This
+    # makes sense since it is required that the sampling interval is smaller than 5 mm.
+    # For multiple channels the profile is truncated to the part that is valid for all channels.
+    n = len(x)
+    for k in np.flatnonzero(starts == 0):
+        row = () if rows is None else (rows[k],)
+        end = ends[k]
+        if x[end - 1] - x[0] > TRUNCATE_THRESHOLD_MM:
+            truncated[0] = max(truncated[0], end)
+        else:
+            y[row + (slice(None, end),)] = y[row + (end,)]
+    for k in np.flatnonzero(ends == n):
+        row = () if rows is None else (rows[k],)
+        start = starts[k]
+        if x[-1] - x[start] > TRUNCATE_THRESHOLD_MM:
+            truncated[1] = min(truncated[1], start)
+        else:
+            y[row + (slice(start, None),)] = y[row + (start - 1,)]
 
-def _handle_startpoints(x, y, cond, truncated):
-    end = _find_invalid_endpoint_intervals(cond)
-    if x[end - 1] - x[0] > TRUNCATE_THRESHOLD_MM:
-        x, y, cond = x[end:], y[end:], cond[end:]
-        truncated[0] = end
-    else:
-        y[:end] = y[end]
-        cond[:end] = False
-    return x, y, truncated, cond
-
-def _handle_endpoints(x, y, cond, truncated):
-    # if there is only one point the left hand side will be 0 thus no truncation.
-    # This makes sense since it is required that the sampling interval is smaller than 5 mm
-    start = - _find_invalid_endpoint_intervals(reversed(cond))
-    if x[-1] - x[start] > TRUNCATE_THRESHOLD_MM:
-        x, y, cond = x[:start], y[:start], cond[:start]
-        truncated[1] = truncated[1] + start
+def _interpolate_runs(x, y, rows, starts, ends):
+    # Linear interpolation between the valid neighbours of each run, written as in scipy's interp1d.
+    lengths = ends - starts
+    idx = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    x_lo, x_hi = np.repeat(x[starts - 1], lengths), np.repeat(x[ends], lengths)
+    if rows is None:
+        y_lo, y_hi = np.repeat(y[starts - 1], lengths), np.repeat(y[ends], lengths)
+        target = idx
     else:
-        y[start:] = y[start - 1]
-        cond[start:] = False
-    return x, y, truncated, cond
+        y_lo, y_hi = np.repeat(y[rows, starts - 1], lengths), np.repeat(y[rows, ends], lengths)
+        target = (np.repeat(rows, lengths), idx)
+    slope = (y_hi - y_lo) / (x_hi - x_lo)
+    y[target] = slope*(x[idx] - x_lo) + y_lo
 
-def interpolate_dropouts(x, y, criteria):
+def interpolate_dropouts(x, y, criteria, out=None, return_runs=False):
     """
     Replaces all invalid values of `y` with linearly interpolated values based on the neighbouring points (see ISO 13473-1 for more information).
 
+    Only the invalid points are touched, each interpolated between the valid points on either side of its run of
+    consecutive dropouts.
+
     :param x: Longitudinal distance in meters.
-    :param y: Vertical displacement in milimeters.
+    :param y: Vertical displacement in milimeters. Either a single profile or an array of shape
+        `(n_channels, len(x))` of several profiles measured at the same `x`.
     :param criteria: Value that defines an invalid measurement in `y`, e.g., `y[n] == criteria` implies that `y[n]` is invalid.
         Thus, `criteria` can be *-9999*, *NaN* or any other special value that indicates an invalid measurement.
+        A boolean array marking the invalid measurements can also be given.
+    :param out: Array of the same shape as `y` where the result is stored. If `None` a copy of `y` is made. Pass `y`
+        itself to interpolate in-place without any full-length copy.
+    :param return_runs: If `True` the runs of consecutive dropouts are returned as well.
 
-    :return: `(y_out, truncated)` where
+    :return: `(y_out, truncated)` or, if `return_runs` is set, `(y_out, truncated, runs)` where
 
-        * `y_out` Interpolated (and possibly truncated) measurement array.
+        * `y_out` Interpolated (and possibly truncated) measurement array. This is a view of `out` if given.
         * `truncated` A tuple `(start, end)` containing the end-points from the original array, i.e., such that
-            `len(y[start:end]) == len(y_out)`. If no truncation have been made the value is `(0, len(y))`.
+            `len(y[start:end]) == len(y_out)`. If no truncation have been made the value is `(0, len(y))`. For
+            multiple channels all channels are truncated to the part where every channel is valid.
+        * `runs` A tuple `(starts, ends)` of index arrays such that `y[starts[n]:ends[n]]` is the n'th run of
+            dropouts in the original array. For multiple channels it is `(channels, starts, ends)`.
 
     *Note* This algorithm does not check if each 100mm segment or the entire profile have enough valid data points.
     """
-    y = y.copy()
     if isinstance(criteria, np.ndarray) and criteria.dtype == np.dtype('bool'):
         cond = criteria
     else:
         cond = _create_dropouts_cond(y, criteria)
-    truncated = [0, len(x)]
-    if cond[0]:
-        x, y, truncated, cond = _handle_startpoints(x, y, cond, truncated)
-    if cond[-1]:
-        x, y, truncated, cond = _handle_endpoints(x, y, cond, truncated)
-    negcond = np.logical_not(cond)
-    f = interp1d(x[negcond], y[negcond], kind='linear', copy=False)
-    y[cond] = f(x[cond])
-    return y, tuple(truncated)
+    if out is None:
+        out = y.copy()
+    elif out is not y:
+        out[...] = y
+    if np.ndim(cond) > 1:
+        rows, starts, ends = _true_runs_2d(cond)
+    else:
+        rows = None
+        starts, ends = _true_runs(cond)
+    n = len(x)
+    truncated = [0, n]
+    if len(starts) > 0:
+        if np.any((starts == 0) & (ends == n)):
+            raise Exception('No valid measurements.')
+        _fill_endpoints(x, out, rows, starts, ends, truncated)
+        interior = (starts > 0) & (ends < n)
+        _interpolate_runs(x, out, None if rows is None else rows[interior], starts[interior], ends[interior])
+    out = out[..., truncated[0]:truncated[1]]
+    runs = (starts, ends) if rows is None else (rows, starts, ends)
+    if return_runs:
+        return out, tuple(truncated), runs
+    return out, tuple(truncated)
 
 
-def envelope(z, d=0, maxiter=100):
+def _iter_interpolate_dropouts(blocks, criteria):
+    """
+    Same as :func:`.interpolate_dropouts` for a profile given as consecutive `(x, y)` blocks. Generator of the
+    interpolated (and possibly truncated) `(x, y)` blocks. The points after the last point that is valid in every
+    channel are held back until the next such point arrives, so every run of dropouts is interpolated from the same
+    neighbours as in the in-memory function.
+    """
+    x_pending = y_pending = None
+    emitted = False
+    for x, y in blocks:
+        x, y = np.asarray(x), np.asarray(y)
+        if x_pending is not None:
+            x = np.concatenate((x_pending, x))
+            y = np.concatenate((y_pending, y), axis=-1)
+        valid = ~_create_dropouts_cond(y, criteria)
+        if valid.ndim > 1:
+            valid = valid.all(axis=0)
+        if not valid.any():
+            x_pending, y_pending = x, y
+            continue
+        last = len(valid) - 1 - np.argmax(valid[::-1])
+        # The first point is the valid point ending the previous block and has already been emitted.
+        skip = 1 if emitted else 0
+        if last + 1 > skip: # Otherwise the new points are all dropouts, which are held back
+            y_out, (start, _) = interpolate_dropouts(x[:last + 1], y[..., :last + 1], criteria)
+            yield x[start + skip:last + 1], y_out[..., skip:]
+            emitted = True
+        x_pending, y_pending = x[last:], y[..., last:]
+    if x_pending is not None and len(x_pending) > (1 if emitted else 0):
+        skip = 1 if emitted else 0
+        y_out, (start, end) = interpolate_dropouts(x_pending, y_pending, criteria)
+        yield x_pending[start + skip:end], y_out[..., skip:]
+
+def _truncated_range(x, y, criteria, start=0, end=None, blocksize=2**20):
+    """
+    The `(start, end)` range of `x` kept by :func:`.interpolate_dropouts` for `x[start:end]`, found from the leading
+    and trailing dropouts only. `y` is read a block at a time from both ends until every channel has a valid point.
+    """
+    end = len(x) if end is None else end
+    channels = np.shape(y)[:-1]
+    first, last = np.full(channels, end), np.full(channels, start)
+    for lo in range(start, end, blocksize):
+        valid = ~_create_dropouts_cond(y[..., lo:min(lo + blocksize, end)], criteria)
+        first = np.where((first == end) & valid.any(axis=-1), lo + np.argmax(valid, axis=-1), first)
+        if np.all(first < end):
+            break
+    for hi in range(end, start, -blocksize):
+        lo = max(hi - blocksize, start)
+        valid = ~_create_dropouts_cond(y[..., lo:hi], criteria)
+        last = np.where((last == start) & valid.any(axis=-1), hi - np.argmax(valid[..., ::-1], axis=-1), last)
+        if np.all(last > start):
+            break
+    if np.any(first == end):
+        raise Exception('No valid measurements.')
+    # Same as _fill_endpoints, leading and trailing dropouts are truncated if they are longer than the threshold.
+    lead = np.where((first > start) & (x[first - 1] - x[start] > TRUNCATE_THRESHOLD_MM), first, start)
+    trail = np.where((last < end) & (x[end - 1] - x[np.minimum(last, end - 1)] > TRUNCATE_THRESHOLD_MM), last, end)
+    return int(np.max(lead)), int(np.min(trail))
+
+
+def envelope(z, d=0, maxiter=100, method='fast'):
     """
     Calculate the enveloped profile according to [#f1]_ with corrections from [#f2]_.
     Intuitively, the algorithm works by imposing an upper limit on the second derivative of the profile, i.e.,
@@ -104,6 +290,9 @@ def envelope(z, d=0, maxiter=100):
     :param z: Vertical displacement.
     :param d: Empirical parameter associated with the tyre stifness.
     :param maxiter: Maximum number of iterations the algorithm performs. This prevents a potential endless loop from occuring.
+    :param method: '*fast*' only revisits the neighbourhood of the points changed in the previous pass, and '*reference*'
+        sweeps the entire profile in every pass. Both perform the same corrections in the same order and thus give
+        identical results.
 
     *Note* The current implementation assumes a uniform distance between datapoints.
 
@@ -112,6 +301,14 @@ def envelope(z, d=0, maxiter=100):
     .. [#f2] http://www.vegvesen.no/_attachment/58581/binary/2256?fast_title=Dr.+Luc+Goubert%3A+Road+surface+texture+and+traffic+noise
 
     """
+    if method=='fast':
+        return _envelope_fast(z, d, maxiter)[0]
+    elif method=='reference':
+        return _envelope_reference(z, d, maxiter)
+    else:
+        raise Exception('method "{}" not known.'.format(method))
+
+def _envelope_reference(z, d, maxiter):
     z = z.copy()
     if d == 0: return z
     C = 0
@@ -151,3 +348,130 @@ def envelope(z, d=0, maxiter=100):
                 C = 0
                 i = 1 # Because zero-indexed
     return z
+
+def _envelope_fast(z, dstar, maxiter):
+    """
+    Returns `(z, passes, corrections, converged)` where `passes` is the number of passes over the profile,
+    `corrections` the total number of corrections and `converged` is `False` if `maxiter` was reached.
+    """
+    z = z.copy()
+    n = len(z)
+    if dstar == 0 or n < 3: return z, 0, 0, True
+    # A point can only be corrected if it violates the condition initially or if one of its neighbours has changed
+    # since it was last checked. The initial violations are found vectorized (with a small margin to be safe against
+    # rounding differences) and the corrections then mark the neighbourhoods that must be checked again.
+    d = z[1:-1] - (z[:-2] + z[2:]) / 2
+    tol = 1e-9 * (np.max(np.abs(z)) + abs(dstar))
+    candidates = (np.flatnonzero((d - dstar > -tol) | (d + dstar < tol)) + 1).tolist()
+    del d
+    passes = 0
+    corrections = 0
+    converged = False
+    for passes in range(1, maxiter):
+        C = 0
+        recheck = []
+        next_candidates = set()
+        k = 0
+        last = 0
+        while True:
+            if recheck and (k == len(candidates) or recheck[0] <= candidates[k]):
+                i = heappop(recheck)
+            elif k < len(candidates):
+                i = candidates[k]
+                k = k + 1
+            else:
+                break
+            if i <= last:
+                continue
+            last = i
+
+            # Same correction as in the reference implementation
+            d = z[i] - (z[i-1] + z[i+1])/2
+            if d - dstar > 0:
+                if z[i-1] - z[i] + dstar > 0:
+                    z[i+1] = z[i+1] + 2 * (d - dstar)
+                    changed = (i + 1,)
+                else:
+                    if z[i+1] - z[i] + dstar < 0:
+                        z[i-1] = z[i] - dstar
+                        z[i+1] = z[i] - dstar
+                        changed = (i - 1, i + 1)
+                    else:
+                        z[i-1] = z[i-1] + 2 * (d - dstar)
+                        changed = (i - 1,)
+            elif d + dstar < 0:
+                z[i] = z[i] - (d-dstar)
+                changed = (i,)
+            else:
+                continue
+            C = C + 1
+
+            for j in changed:
+                for neighbour in range(max(j - 1, 1), min(j + 2, n - 1)):
+                    if neighbour > i:
+                        heappush(recheck, neighbour)
+                    else:
+                        next_candidates.add(neighbour)
+        corrections = corrections + C
+        if C == 0:
+            converged = True
+            break
+        candidates = sorted(next_candidates)
+    return z, passes, corrections, converged
+
+ENVELOPE_WINDOW_DTYPE = np.dtype([
+    ('start', np.intp),
+    ('end', np.intp),
+    ('passes', np.intp),
+    ('corrections', np.intp),
+    ('converged', bool),
+    ])
+
+def envelope_windowed(z, d=0, maxiter=100, window=20000, overlap=2000, n_jobs=1):
+    """
+    Calculate the enveloped profile as in :func:`.envelope`, but with each window of the profile converging on its
+    own. Each window of `window` points is enveloped together with `overlap` points on both sides, and only the
+    result of the window itself is kept. The windows are independent and can be processed in parallel.
+
+    The result equals :func:`.envelope` as long as corrections do not propagate further than `overlap` points, which
+    holds in practice when the overlap is much larger than the tyre contact length.
+
+    :param z: Vertical displacement.
+    :param d: Same as :func:`.envelope`.
+    :param maxiter: Same as :func:`.envelope` but for each window.
+    :param window: Number of points in each window.
+    :param overlap: Number of points on each side of a window that are enveloped together with the window.
+    :param n_jobs: Number of processes used. If 1 the windows are processed in the calling process.
+    :return: `(z_out, windows)` where
+
+        * `z_out` is the enveloped profile.
+        * `windows` is a structured array (see `ENVELOPE_WINDOW_DTYPE`) with one entry per window containing the
+          `start` and `end` index of the window, the number of `passes` used, the number of `corrections` made and if
+          the window `converged`, i.e., `False` if `maxiter` was reached.
+    """
+    n = len(z)
+    starts = np.arange(0, n, window)
+    ends = np.minimum(starts + window, n)
+    lower = np.maximum(starts - overlap, 0)
+    upper = np.minimum(ends + overlap, n)
+    tasks = [z[l:u] for l, u in zip(lower, upper)]
+    func = partial(_envelope_fast, dstar=d, maxiter=maxiter)
+    z_out = np.empty_like(z)
+    windows = np.zeros((len(starts),), dtype=ENVELOPE_WINDOW_DTYPE)
+    windows['start'] = starts
+    windows['end'] = ends
+    if n_jobs == 1:
+        _collect_windows(map(func, tasks), z_out, windows, lower)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            _collect_windows(executor.map(func, tasks), z_out, windows, lower)
+    return z_out, windows
+
+def _collect_windows(results, z_out, windows, lower):
+    # Copy the window part of each enveloped (overlapping) window to z_out and record its statistics.
+    for k, (z_window, passes, corrections, converged) in enumerate(results):
+        start, end = windows['start'][k], windows['end'][k]
+        z_out[start:end] = z_window[start - lower[k]:end - lower[k]]
+        windows['passes'][k] = passes
+        windows['corrections'][k] = corrections
+        windows['converged'][k] = converged
@@ -7,8 +7,23 @@ from numpy import cos, sin, arccos, sqrt, fabs
 
 RAD_EARTH_METER = 6373000
 DEGREES2RADIANS = PI/180.0
+STRAIGHT_RADIUS = 10000 # Curvature radius in meters used for straight road
 
-def calc_curvature_radi(wgs_N, wgs_E):
+def calc_curvature_radi(wgs_N, wgs_E, method='spherical'):
+    """
+    Curvature radius in meters at each GPS fix from the circle through the fix and its neighbours.
+
+    :param wgs_N: Latitude in degrees.
+    :param wgs_E: Longitude in degrees.
+    :param method: '*spherical*' uses the great circle distances between the fixes. '*chord*' uses the chords between
+        the fixes as unit vectors (see :func:`.iter_curvature_radius`), which is precise for closely spaced fixes and
+        handles repeated fixes and straight road.
+    """
+    if method=='chord':
+        radius = list(iter_curvature_radius([(wgs_N, wgs_E)]))
+        return np.concatenate(radius) if radius else np.zeros((0,))
+    elif method!='spherical':
+        raise Exception('method "{}" not known.'.format(method))
     curves = np.zeros(wgs_N.shape)
     dist_ab = distance_on_unit_sphere(wgs_N[:-1], wgs_E[:-1], wgs_N[1:], wgs_E[1:])
     dist_c = distance_on_unit_sphere(wgs_N[:-2], wgs_E[:-2], wgs_N[2:], wgs_E[2:])
@@ -24,11 +39,10 @@ def calc_lengths(wgs_N, wgs_E):
 def circum_circle_radius(a, b, c):
 # Circumcircle radius calculation from http://www.mathopenref.com/trianglecircumcircle.html
 # or https://en.wikipedia.org/wiki/Circumscribed_circle#Other_properties
-    try:
-        divider = sqrt(fabs((a+b+c) * (b+c-a) * (c+a-b) * (a+b-c)))
-        return (a * b * c) / divider
-    except ZeroDivisionError:
-        return 10000
+    divider = sqrt(fabs((a+b+c) * (b+c-a) * (c+a-b) * (a+b-c)))
+    # numpy arrays do not raise ZeroDivisionError, so straight segments are handled explicitly.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(divider > 0, (a * b * c) / np.where(divider > 0, divider, 1), STRAIGHT_RADIUS)
 
 def distance_on_unit_sphere(lat1, long1, lat2, long2):
     # NOTE this guy has more accurate calculation methods here: https://github.com/balzer82/LatLon2Meter/blob/master/LatLon2Meter.py
@@ -51,3 +65,136 @@ def distance_on_unit_sphere(lat1, long1, lat2, long2):
     # Remember to multiply arc by the radius of the earth
     # in your favorite set of units to get length.
     return arc * RAD_EARTH_METER
+
+def iter_curvature_radius(chunks):
+    """
+    Curvature radius in meters at each GPS fix of a track given as consecutive `(wgs_N, wgs_E)` chunks, e.g., read from
+    a log of several days. Only the last two distinct fixes are carried over between chunks, so the memory use does not
+    depend on the length of the track.
+
+    Each fix is converted to a unit vector once. The radius of the circle through three fixes is computed from the
+    chords between them as `|AB| |BC| |AC| / (2 |AB x BC|)`, which unlike `arccos` of a dot product keeps its precision
+    for fixes less than a meter apart. Repeated fixes (e.g., when standing still) are given the radius of the fix they
+    repeat, and straight road, i.e., collinear fixes or radii larger than `STRAIGHT_RADIUS`, gives `STRAIGHT_RADIUS`.
+    As in :func:`.calc_curvature_radi` the first and last fixes get the radius of their neighbour.
+
+    :param chunks: Iterable of `(wgs_N, wgs_E)` arrays in degrees.
+    :return: Generator of radius arrays. The radius of a fix is only known once the next distinct fix has been read, so
+        the arrays are delayed relative to the chunks, but concatenated they match the fixes of the track.
+    """
+    points = np.zeros((0, 3)) # Distinct fixes whose neighbours are still needed
+    sizes = np.zeros((0,), dtype=np.intp) # Number of fixes of each of the points not yet returned
+    started = False # If the first radius is known
+    last_radius = STRAIGHT_RADIUS
+    for wgs_N, wgs_E in chunks:
+        vectors = _unit_vectors(wgs_N, wgs_E)
+        if len(vectors) == 0:
+            continue
+        previous = np.concatenate((points[-1:] if len(points) else np.full((1, 3), np.nan), vectors[:-1]))
+        new_starts = np.flatnonzero(np.any(vectors != previous, axis=1))
+        # Fixes repeating the last point of the previous chunk belong to it.
+        repeats = new_starts[0] if len(new_starts) else len(vectors)
+        if repeats:
+            sizes[-1] += repeats
+        points = np.concatenate((points, vectors[new_starts]))
+        sizes = np.concatenate((sizes, np.diff(np.append(new_starts, len(vectors)))))
+        if len(points) < 3:
+            continue
+        radius = np.empty((len(points),))
+        radius[1:-1] = _chord_radius(points[:-2], points[1:-1], points[2:])
+        if not started:
+            radius[0] = radius[1]
+            started = True
+        last_radius = radius[-2]
+        yield np.repeat(radius[:-1], sizes[:-1])
+        points, sizes = points[-2:], np.array([0, sizes[-1]])
+    if started:
+        yield np.full((sizes[-1],), last_radius)
+    elif sizes.sum():
+        yield np.full((sizes.sum(),), float(STRAIGHT_RADIUS))
+
+def _unit_vectors(wgs_N, wgs_E):
+    # Computes the trigonometric functions once per fix.
+    lat = np.asarray(wgs_N, dtype=float) * DEGREES2RADIANS
+    lon = np.asarray(wgs_E, dtype=float) * DEGREES2RADIANS
+    cos_lat = cos(lat)
+    return np.stack((cos_lat * cos(lon), cos_lat * sin(lon), sin(lat)), axis=-1)
+
+def _chord_radius(a, b, c):
+    ab, bc, ac = b - a, c - b, c - a
+    cross = np.linalg.norm(np.cross(ab, bc), axis=-1)
+    product = np.linalg.norm(ab, axis=-1) * np.linalg.norm(bc, axis=-1) * np.linalg.norm(ac, axis=-1)
+    # Straight if 2 |AB x BC| <= |AB| |BC| |AC| / STRAIGHT_RADIUS, which includes collinear fixes.
+    straight = 2 * cross * STRAIGHT_RADIUS <= product * RAD_EARTH_METER
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(straight, STRAIGHT_RADIUS, RAD_EARTH_METER * product / (2 * np.where(straight, 1, cross)))
+
+def _arc_lengths(vectors):
+    # Great circle distances between consecutive unit vectors from the chord lengths. Unlike the arccos of the dot
+    # product this is accurate for fixes centimeters apart and exactly 0 for repeated fixes.
+    chord = np.linalg.norm(np.diff(vectors, axis=0), axis=-1)
+    return RAD_EARTH_METER * 2 * np.arcsin(np.minimum(chord / 2, 1))
+
+GPS_POSITION_DTYPE = np.dtype([
+    ('chainage', float),
+    ('wgs_N', float),
+    ('wgs_E', float),
+    ('curvature_radius', float),
+    ])
+
+class GPSChainage:
+    """
+    Link a GPS track to the chainage of a profile. The cumulative distance along the track is computed once and kept as
+    a sorted index, so coordinates and curvature of any number of profile positions are found by one vectorized binary
+    search and linear interpolation between the neighbouring fixes.
+
+    :param wgs_N: Latitude of each GPS fix in degrees.
+    :param wgs_E: Longitude of each GPS fix in degrees.
+    :param distance: Chainage in meters of each fix, e.g., from an odometer. If `None` it is the distance along the
+        track from the first fix.
+    :param offset: Chainage in meters of the first fix, i.e., the profile position `x` where the track starts.
+    """
+    def __init__(self, wgs_N, wgs_E, distance=None, offset=0.0):
+        self.wgs_N = np.asarray(wgs_N, dtype=float)
+        self.wgs_E = np.asarray(wgs_E, dtype=float)
+        if distance is None:
+            lengths = _arc_lengths(_unit_vectors(self.wgs_N, self.wgs_E))
+            distance = np.concatenate(([0], np.cumsum(lengths)))
+        self.chainage = np.asarray(distance, dtype=float) + offset
+        if np.any(np.diff(self.chainage) < 0):
+            raise Exception('Chainage of the GPS fixes must be non-decreasing.')
+        self.curvature_radius = calc_curvature_radi(self.wgs_N, self.wgs_E, method='chord')
+
+    def locate(self, x):
+        """
+        Coordinates and curvature radius at the profile positions `x`. Positions outside the track get the values of
+        the first or last fix.
+
+        :param x: Chainage in meters, e.g., the `x_interval` returned by :func:`.calculate_mpd`.
+        :return: Structured array (see `GPS_POSITION_DTYPE`) of the same shape as `x`.
+        """
+        x = np.asarray(x, dtype=float)
+        result = np.empty(x.shape, dtype=GPS_POSITION_DTYPE)
+        result['chainage'] = x
+        # Find the enclosing fixes once and use the same weights for all the columns.
+        right = np.clip(np.searchsorted(self.chainage, x, side='right'), 1, len(self.chainage) - 1)
+        left = right - 1
+        span = self.chainage[right] - self.chainage[left]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.clip(np.where(span > 0, (x - self.chainage[left]) / span, 0), 0, 1)
+        for name, values in (('wgs_N', self.wgs_N), ('wgs_E', self.wgs_E), ('curvature_radius', self.curvature_radius)):
+            result[name] = values[left] + weight * (values[right] - values[left])
+        return result
+
+    def locate_intervals(self, x_interval):
+        """
+        Coordinates of the start and end of the consecutive intervals `x_interval` (as returned by
+        :func:`.calculate_mpd`) and the curvature radius at the middle of each interval.
+
+        :return: `(start, end, curvature_radius)` where `start` and `end` are structured arrays as returned by
+            :meth:`locate`.
+        """
+        x_interval = np.asarray(x_interval, dtype=float)
+        positions = self.locate(x_interval)
+        middle = self.locate((x_interval[:-1] + x_interval[1:]) / 2)
+        return positions[:-1], positions[1:], middle['curvature_radius']
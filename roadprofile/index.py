@@ -0,0 +1,111 @@
+import json
+import os
+import numpy as np
+
+from .filtering import mpd_butterworth
+from .mpd import _segment_midpoints
+from .utils import _epsilon, _chain_segments, _max_table, _query_max_table, _mean_each_evaluation_length
+
+INDEX_FORMAT_VERSION = 1
+
+class MPDIndex:
+    """
+    Index of a profile for calculating MSD and MPD over arbitrary ranges `[x0, x1]` without slicing and segmenting the
+    profile for every query, e.g., in an interactive viewer.
+
+    The index holds the start of the next evaluation segment for every point and a sparse table of range maxima of the
+    profile up to the length of a segment. A query walks the chain of segments in the range and looks up the peak of
+    each segment half in constant time, so its cost is proportional to the number of segments in the range.
+
+    Slope suppression depends on each segment and cannot be indexed, so only the '*no filtering*' and '*butterworth*'
+    methods of :func:`.calculate_mpd` are supported. With '*butterworth*' the entire profile is filtered when the
+    index is built.
+
+    :param x: Longitudinal distance in meters.
+    :param y: Vertical displacement in milimeters. Multiple channels are supported as in :func:`.calculate_mpd`.
+    :param method: '*no filtering*' or '*butterworth*', see :func:`.calculate_mpd`.
+    :param seglen: Same as :func:`.calculate_mpd`.
+    """
+    def __init__(self, x, y, method='no filtering', seglen=0.1):
+        x = np.asarray(x)
+        if method=='butterworth':
+            y = mpd_butterworth(x, y)
+        elif method!='no filtering':
+            raise Exception('method "{}" not known.'.format(method))
+        self.x = x
+        self.method = method
+        self.seglen = seglen
+        self.next_start = np.searchsorted(x, x + (seglen - _epsilon), side='left') + 1
+        complete = np.flatnonzero(self.next_start <= len(x))
+        maxlength = (self.next_start[complete] - complete).max() if len(complete) else 1
+        self.table = _max_table(np.asarray(y), maxlength)
+
+    def segments(self, x0, x1):
+        """
+        Evaluation segments in `[x0, x1]`. These are the segments :func:`.segment_boundaries` finds for the part of
+        the profile in the range.
+
+        :return: `(starts, ends)` index arrays into the indexed profile.
+        """
+        start, stop = self._range(x0, x1)
+        return _chain_segments(self.next_start, start, stop)
+
+    def msd(self, x0, x1):
+        """
+        MSD of each evaluation segment in `[x0, x1]`.
+
+        :return: `(x_start, x_end, msd)` as in :func:`.calculate_mpd_sliding`.
+        """
+        starts, ends = self.segments(x0, x1)
+        return self.x[starts], self.x[ends - 1], self._msd(starts, ends)
+
+    def mpd(self, x0, x1, nmean=10):
+        """
+        MPD of the part of the profile in `[x0, x1]`. With the '*no filtering*' method this is the same as
+        :func:`.calculate_mpd` for that part. With '*butterworth*' the part is taken from the profile filtered as a
+        whole, while :func:`.calculate_mpd` would filter the part on its own, starting from rest with a transient at
+        the start of the part, so the results differ.
+
+        :return: `(x_interval, mpd)` as in :func:`.calculate_mpd`.
+        """
+        starts, ends = self.segments(x0, x1)
+        start, _ = self._range(x0, x1)
+        return _mean_each_evaluation_length(self.x[start:], self._msd(starts, ends), ends - start, nmean)
+
+    def _range(self, x0, x1):
+        return int(np.searchsorted(self.x, x0, side='left')), int(np.searchsorted(self.x, x1, side='right'))
+
+    def _msd(self, starts, ends):
+        if len(starts) == 0:
+            return np.zeros(self.table.shape[2:] + (0,))
+        mids = _segment_midpoints(self.x, starts, ends)
+        return (_query_max_table(self.table, starts, mids) + _query_max_table(self.table, mids, ends)) / 2
+
+    def save(self, path):
+        """
+        Save the index to the directory `path`, which is created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'x.npy'), self.x)
+        np.save(os.path.join(path, 'next_start.npy'), self.next_start)
+        np.save(os.path.join(path, 'table.npy'), self.table)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'version': INDEX_FORMAT_VERSION, 'method': self.method, 'seglen': self.seglen}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load an index saved by :meth:`save`. By default the arrays are memory-mapped, so only the parts used by the
+        queries are read from disk.
+        """
+        with open(os.path.join(path, 'index.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != INDEX_FORMAT_VERSION:
+            raise Exception('index version "{}" not known.'.format(meta['version']))
+        index = cls.__new__(cls)
+        index.method = meta['method']
+        index.seglen = meta['seglen']
+        index.x = np.load(os.path.join(path, 'x.npy'), mmap_mode=mmap_mode)
+        index.next_start = np.load(os.path.join(path, 'next_start.npy'), mmap_mode=mmap_mode)
+        index.table = np.load(os.path.join(path, 'table.npy'), mmap_mode=mmap_mode)
+        return index
@@ -0,0 +1,132 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import io
+import os
+import numpy as np
+
+from .filtering import _create_dropouts_cond
+from .storage import ProfileWriter, open_profile
+
+def iter_read_text(path, delimiter=',', skiprows=0, x_column=0, y_columns=1, dropout_criteria=None, blocksize=2**26,
+        n_jobs=1):
+    """
+    Read a delimited text file of a profile block by block. Each block of about `blocksize` bytes of complete lines is
+    parsed by numpy's C parser in one call without creating Python objects for the values, and the dropouts are found
+    while the block is in memory. Parsing the numbers is the bottleneck, so with `n_jobs > 1` the blocks are parsed by
+    a pool of processes while the next blocks are read.
+
+    :param path: Text file with one measurement per line.
+    :param delimiter: Column delimiter. If `None` the columns are separated by whitespace.
+    :param skiprows: Number of header lines to skip.
+    :param x_column: Column of the longitudinal distance.
+    :param y_columns: Column of the vertical displacement, or a sequence of columns for multiple channels.
+    :param dropout_criteria: Dropout criteria as in :func:`.interpolate_dropouts`. If `None` dropouts are not marked.
+    :param blocksize: Number of bytes read at a time.
+    :param n_jobs: Number of processes parsing blocks. If 1 the blocks are parsed in the calling process.
+    :return: Generator of `(x, y, dropouts)` where `dropouts` is a boolean array marking the dropouts of `y` or `None`.
+    """
+    parse = partial(_parse_block, delimiter=delimiter, x_column=x_column, y_columns=y_columns,
+            dropout_criteria=dropout_criteria)
+    blocks = _iter_blocks(path, skiprows, blocksize)
+    if n_jobs == 1:
+        yield from map(parse, blocks)
+        return
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        # At most 2 * n_jobs blocks are in memory at a time.
+        pending = deque()
+        for block in blocks:
+            pending.append(executor.submit(parse, block))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def read_text(path, delimiter=',', skiprows=0, x_column=0, y_columns=1, dropout_criteria=None, blocksize=2**26,
+        n_jobs=1):
+    """
+    Read a delimited text file of a profile into arrays, see :func:`.iter_read_text` for the parameters. The arrays
+    are allocated from an estimate of the number of lines in the file and filled block by block.
+
+    :return: `(x, y, dropouts)` where `dropouts` is a boolean array marking the dropouts of `y`, which can be passed as
+        `criteria` to :func:`.interpolate_dropouts`, or `None` if `dropout_criteria` is `None`.
+    """
+    filesize = os.path.getsize(path)
+    channels = (len(y_columns),) if np.ndim(y_columns) else ()
+    x = y = dropouts = None
+    n = 0
+    for x_block, y_block, dropouts_block in iter_read_text(path, delimiter, skiprows, x_column, y_columns,
+            dropout_criteria, blocksize, n_jobs):
+        if x is None:
+            # Estimate the number of lines from the bytes per line of the first block.
+            nbytes = min(blocksize, filesize)
+            size = max(int(filesize / nbytes * len(x_block) * 1.05), len(x_block))
+            x, y = np.empty((size,)), np.empty(channels + (size,))
+            dropouts = None if dropouts_block is None else np.empty(channels + (size,), dtype=bool)
+        if n + len(x_block) > len(x):
+            size = 2 * (n + len(x_block))
+            x, y = _grow(x, size), _grow(y, size)
+            dropouts = None if dropouts is None else _grow(dropouts, size)
+        x[n:n + len(x_block)] = x_block
+        y[..., n:n + len(x_block)] = y_block
+        if dropouts is not None:
+            dropouts[..., n:n + len(x_block)] = dropouts_block
+        n += len(x_block)
+    if x is None:
+        x, y = np.zeros((0,)), np.zeros(channels + (0,))
+        dropouts = None if dropout_criteria is None else np.zeros(channels + (0,), dtype=bool)
+    return x[:n], y[..., :n], None if dropouts is None else dropouts[..., :n]
+
+def ingest_text(path, profile_path, delimiter=',', skiprows=0, x_column=0, y_columns=1, dropout_criteria=None,
+        blocksize=2**26, n_jobs=1, sampling_rate=None, chunk_size=2**20, dtype='<f8'):
+    """
+    Convert a delimited text file of a profile to the on-disk format of :func:`.write_profile` block by block, so the
+    profile is never held in memory. See :func:`.iter_read_text` and :class:`.ProfileWriter` for the parameters.
+
+    :return: `(profile, dropouts)` where `profile` is the written profile opened by :func:`.open_profile` and
+        `dropouts` the number of dropouts found or `None` if `dropout_criteria` is `None`.
+    """
+    channels = (len(y_columns),) if np.ndim(y_columns) else ()
+    dropouts = None if dropout_criteria is None else 0
+    with ProfileWriter(profile_path, channels, sampling_rate, dropout_criteria, chunk_size, dtype) as writer:
+        for x, y, dropouts_block in iter_read_text(path, delimiter, skiprows, x_column, y_columns, dropout_criteria,
+                blocksize, n_jobs):
+            writer.write(x, y)
+            if dropouts_block is not None:
+                dropouts += int(np.count_nonzero(dropouts_block))
+    return open_profile(profile_path), dropouts
+
+def _iter_blocks(path, skiprows, blocksize):
+    # Blocks of complete lines, the rest of a block is carried over to the next one.
+    with open(path, 'rb') as f:
+        for _ in range(skiprows):
+            f.readline()
+        remainder = b''
+        while True:
+            data = f.read(blocksize)
+            if not data:
+                break
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                remainder += data
+                continue
+            block, remainder = remainder + data[:end], data[end:]
+            if block.strip():
+                yield block
+        if remainder.strip():
+            yield remainder
+
+def _parse_block(block, delimiter, x_column, y_columns, dropout_criteria):
+    columns = [x_column] + (list(y_columns) if np.ndim(y_columns) else [y_columns])
+    try:
+        values = np.loadtxt(io.BytesIO(block), delimiter=delimiter, usecols=columns, ndmin=2)
+    except ValueError as e:
+        raise Exception('could not parse the text file: {}'.format(e))
+    x = values[:, 0]
+    y = values[:, 1:].T if np.ndim(y_columns) else values[:, 1]
+    return x, y, None if dropout_criteria is None else _create_dropouts_cond(y, dropout_criteria)
+
+def _grow(a, size):
+    grown = np.empty(a.shape[:-1] + (size,), dtype=a.dtype)
+    grown[..., :a.shape[-1]] = a
+    return grown
@@ -1,35 +1,111 @@
 import numpy as np
 from numpy import mean
 
-from .utils import apply_each_evaluation_length_and_save_result
-from .filtering import mpd_butterworth
+from .utils import apply_each_evaluation_length_batched, iter_each_evaluation_length_batched, sliding_segment_boundaries, _range_max, _work_dtype, _segment_result
+from .filtering import mpd_butterworth, _mpd_butterworth_stream
 
-def calculate_mpd(x, y, method='slope', seglen=0.1, nmean=10):
+def calculate_mpd(x, y, method='slope', seglen=0.1, nmean=10, n_jobs=1, backend='process', out=None,
+        return_segments=False):
     """
     Calculate mean profile depth (MPD) according to ISO-13473-1.
 
     :param x: Longitudinal distance in meters.
-    :param y: Vertical displacement in milimeters.
+    :param y: Vertical displacement in milimeters. Either a single profile or an array of shape `(n_channels, len(x))`
+        of several profiles (e.g. laser lines) measured at the same `x`, in which case `mpd` has shape
+        `(n_channels, len(x_interval) - 1)`. The segmentation is computed once and shared by all channels. A float32
+        `y` is processed in float32 and gives float32 MPD values.
     :param str method: Profile filtering method used. '*slope*' uses slope suppression according to ISO-13473-1, '*butterworth*' uses the high- and low-pass filtering according to ISO-13473-1, and '*no filtering*' applies no filtering at all.
     :param int seglen: Length of evaluation segment used in MPD calculations. Default is 10 cm as specified in ISO-13473-1. Each segment is chosen to be the least segment that is equal to or larger than `seglen`.
     :param int nmean: Number of Mean Segment Depth (MSD) values that is being averaged into one MPD value. Default is 10 which is the *least* value recommended in the ISO standard (with seglen=0.1).
-    :return: `(x_interval, mpd)` where
+    :param int n_jobs: Number of workers the evaluation segments are split between (see :func:`.map_segments`). If `None`
+        the number of CPUs is used. The result is identical to the serial calculation. Note that the Butterworth
+        filtering itself is sequential.
+    :param str backend: '*process*' or '*thread*', see :func:`.map_segments`.
+    :param out: Array the MPD values are written to, of shape `(len(x_interval) - 1,)` or `(n_channels,
+        len(x_interval) - 1)`, see :func:`.evaluation_counts`. It is returned as `mpd`.
+    :param bool return_segments: If `True` the MSD of every evaluation segment is returned as well.
+    :return: `(x_interval, mpd)` or, if `return_segments` is set, `(x_interval, mpd, segments)` where
 
         * `x_interval` is an array with length `len(mpd) + 1` of start/end values of the consecutive intervals where MPD have been calculated.
         * `mpd` array of calculated MPD values.
+        * `segments` structured array with one row per evaluation segment and the fields `'start'`, `'end'`, `'msd'`
+          and `'valid'`. A segment is not valid if it is after the last complete evaluation length (and not part of an
+          MPD value) or its MSD is not finite. For multiple channels `'msd'` and `'valid'` have shape `(n_channels,)`.
 
     """
 
     if method=='slope':
-        x_list, mpd_list = apply_each_evaluation_length_and_save_result(x,y, _calc_mpd_core_w_slopesupress, nmean, seglen)
+        func = _calc_msd_batch_w_slopesupress
     elif method=='butterworth':
         y = mpd_butterworth(x, y)
-        x_list, mpd_list = apply_each_evaluation_length_and_save_result(x,y, _calc_mpd_core, nmean, seglen)
+        func = _calc_msd_batch
     elif method=='no filtering':
-        x_list, mpd_list = apply_each_evaluation_length_and_save_result(x,y, _calc_mpd_core, nmean, seglen)
+        func = _calc_msd_batch
     else:
         raise Exception('method "{}" not known.'.format(method))
-    return np.array(x_list), np.array(mpd_list)
+    result = apply_each_evaluation_length_batched(x, y, func, nmean, seglen, n_jobs, backend, out, return_segments)
+    if return_segments:
+        x_interval, mpd, (starts, ends, msd) = result
+        return x_interval, mpd, _segment_result(x, starts, ends, {'msd': msd}, nmean)
+    return result
+
+def iter_calculate_mpd(chunks, method='slope', seglen=0.1, nmean=10, sampling_rate=None):
+    """
+    Calculate MPD as in :func:`.calculate_mpd` for a profile given as an iterable of consecutive `(x, y)` chunks, e.g.,
+    read block by block from disk. Segments crossing chunk borders, incomplete groups of `nmean` segments and the
+    Butterworth filter state are carried over between chunks, so only a chunk and a segment are kept in memory.
+
+    :param chunks: Iterable of `(x, y)` array pairs.
+    :param method: Same as :func:`.calculate_mpd`.
+    :param seglen: Same as :func:`.calculate_mpd`.
+    :param nmean: Same as :func:`.calculate_mpd`.
+    :param sampling_rate: Distance between measurements in meters used by the '*butterworth*' method. If `None` it is
+        estimated from the first chunk. :func:`.calculate_mpd` uses the mean distance of the entire profile, so pass
+        that value to get identical results.
+    :return: Generator of `(x_interval, mpd)` as in :func:`.calculate_mpd` for the MPD values completed by each chunk.
+        Concatenating the `mpd` arrays gives the same result as :func:`.calculate_mpd` on the entire profile.
+    """
+    prepare = None
+    if method=='slope':
+        func = _calc_msd_batch_w_slopesupress
+    elif method=='butterworth':
+        func = _calc_msd_batch
+        prepare = _mpd_butterworth_stream(sampling_rate)
+    elif method=='no filtering':
+        func = _calc_msd_batch
+    else:
+        raise Exception('method "{}" not known.'.format(method))
+    return iter_each_evaluation_length_batched(chunks, func, nmean, seglen, prepare)
+
+def calculate_mpd_sliding(x, y, stride=0.01, method='slope', seglen=0.1):
+    """
+    Calculate the mean segment depth (MSD) of overlapping evaluation segments starting every `stride` meters (see
+    :func:`.sliding_segment_boundaries`), e.g., to localise defects more precisely than the back-to-back segments of
+    :func:`.calculate_mpd`. No averaging over `nmean` segments is done, each value is the MSD of a single segment.
+
+    For the '*butterworth*' and '*no filtering*' methods the peaks of the segment halves are range maxima of the same
+    profile, which are found from a sparse table of maxima so the cost grows with the length of the profile and not
+    with the overlap. With '*slope*' each segment has its own regression line, and the segments are evaluated in
+    batches.
+
+    :param x: Longitudinal distance in meters.
+    :param y: Vertical displacement in milimeters. Multiple channels are supported as in :func:`.calculate_mpd`.
+    :param stride: Distance in meters between the start of neighbouring segments.
+    :param method: Same as :func:`.calculate_mpd`.
+    :param seglen: Same as :func:`.calculate_mpd`.
+    :return: `(x_start, x_end, msd)` where `x_start` and `x_end` are the first and last distance of each segment
+        and `msd` the MSD of each segment.
+    """
+    starts, ends = sliding_segment_boundaries(x, seglen, stride)
+    if method=='slope':
+        msd = _calc_msd_sliding_w_slopesupress(x, y, starts, ends)
+    elif method=='butterworth':
+        msd = _calc_msd_sliding(x, mpd_butterworth(x, y), starts, ends)
+    elif method=='no filtering':
+        msd = _calc_msd_sliding(x, y, starts, ends)
+    else:
+        raise Exception('method "{}" not known.'.format(method))
+    return x[starts], x[ends - 1], msd
 
 def _calc_mpd_core_w_slopesupress(xsub, ysub):
     ysub = ysub - np.polyval(np.polyfit(xsub, ysub, 1), xsub)
@@ -40,3 +116,101 @@ def _calc_mpd_core(xsub, ysub):
     msd1 = max(ysub[:idx])
     msd2 = max(ysub[idx:])
     return mean((msd1, msd2))
+
+def _calc_msd_batch_w_slopesupress(x, y, starts, ends):
+    """
+    Same as :func:`._calc_mpd_core_w_slopesupress` but for all segments at once. The segments must be consecutive as
+    returned by :func:`.segment_boundaries`.
+    """
+    if len(starts) == 0:
+        return np.zeros(np.shape(y)[:-1] + (0,))
+    first = starts[0]
+    return _calc_msd_batch(x[first:], _suppress_slope_batch(x, y, starts, ends), starts - first, ends - first)
+
+def _suppress_slope_batch(x, y, starts, ends):
+    """
+    Subtract the least squares line of each of the consecutive segments from `y`. The regression is computed in closed
+    form from the segment sums of x, y, xy and x² and the result covers `y[starts[0]:ends[-1]]`.
+    """
+    first, last = starts[0], ends[-1]
+    lengths = ends - starts
+    offsets = starts - first
+    dtype = _work_dtype(y)
+    counts = lengths.astype(dtype)
+    # Center each segment on its first point to avoid cancellation in the sums below. The distances within a segment
+    # are small, so they are exact enough in the precision of the profile.
+    xc = (x[first:last] - np.repeat(x[starts], lengths)).astype(dtype, copy=False)
+    yc = y[..., first:last] - np.repeat(y[..., starts], lengths, axis=-1)
+    sum_x = np.add.reduceat(xc, offsets)
+    sum_xx = np.add.reduceat(xc * xc, offsets)
+    sum_y = np.add.reduceat(yc, offsets, axis=-1)
+    sum_xy = np.add.reduceat(xc * yc, offsets, axis=-1)
+    mean_x = sum_x / counts
+    mean_y = sum_y / counts
+    slope = (sum_xy - sum_x * mean_y) / (sum_xx - sum_x * mean_x)
+    intercept = mean_y - slope * mean_x
+    return yc - (np.repeat(slope, lengths, axis=-1) * xc + np.repeat(intercept, lengths, axis=-1))
+
+def _calc_msd_batch(x, y, starts, ends):
+    """
+    Same as :func:`._calc_mpd_core` but for all segments `x[starts[n]:ends[n]]` at once. The segments must be ordered
+    and non-overlapping as returned by :func:`.segment_boundaries`.
+    """
+    if len(starts) == 0:
+        return np.zeros(np.shape(y)[:-1] + (0,))
+    mids = _segment_midpoints(x, starts, ends)
+    # Peaks of [start, mid) and [mid, end) for each segment. The range [end, next start) is empty for consecutive
+    # segments and its (single element) result is discarded.
+    bounds = np.stack((starts, mids, ends), axis=-1).ravel()[:-1]
+    peaks = np.maximum.reduceat(y[..., :ends[-1]], bounds, axis=-1)
+    return (peaks[..., 0::3] + peaks[..., 1::3]) / 2
+
+def _segment_midpoints(x, starts, ends):
+    mids = np.searchsorted(x, x[starts] + 0.05, side='right')
+    if np.any(mids >= ends):
+        raise Exception('Evaluation segments must be longer than 50 mm.')
+    return mids
+
+def _calc_msd_sliding(x, y, starts, ends):
+    """
+    Same as :func:`._calc_msd_batch` for segments that may overlap.
+    """
+    y = np.asarray(y)
+    if len(starts) == 0:
+        return np.zeros(y.shape[:-1] + (0,))
+    mids = _segment_midpoints(x, starts, ends)
+    return (_range_max(y, starts, mids) + _range_max(y, mids, ends)) / 2
+
+def _calc_msd_sliding_w_slopesupress(x, y, starts, ends, batchsize=2**22):
+    """
+    Same as :func:`._calc_msd_batch_w_slopesupress` for segments that may overlap. The points of a batch of segments
+    are gathered into a padded array of shape `(segments, longest segment)` holding about `batchsize` values.
+    """
+    y = np.asarray(y)
+    if len(starts) == 0:
+        return np.zeros(y.shape[:-1] + (0,))
+    mids = _segment_midpoints(x, starts, ends)
+    dtype = _work_dtype(y)
+    result = np.empty(y.shape[:-1] + (len(starts),), dtype=dtype)
+    width = (ends - starts).max()
+    step = max(batchsize // width, 1)
+    column = np.arange(width)
+    for first in range(0, len(starts), step):
+        lo, mid, hi = starts[first:first + step, None], mids[first:first + step, None], ends[first:first + step, None]
+        idx = lo + column
+        inside = idx < hi
+        idx = np.where(inside, idx, lo)
+        lengths = (hi[:, 0] - lo[:, 0]).astype(dtype)
+        # Regression on each segment centered on its first point, as in _suppress_slope_batch.
+        xc = np.where(inside, x[idx] - x[lo], 0).astype(dtype, copy=False)
+        yc = np.where(inside, y[..., idx] - y[..., lo], 0)
+        sum_x, sum_xx = xc.sum(axis=-1), (xc * xc).sum(axis=-1)
+        sum_y, sum_xy = yc.sum(axis=-1), (xc * yc).sum(axis=-1)
+        mean_x, mean_y = sum_x / lengths, sum_y / lengths
+        slope = (sum_xy - sum_x * mean_y) / (sum_xx - sum_x * mean_x)
+        intercept = mean_y - slope * mean_x
+        residual = yc - (slope[..., None] * xc + intercept[..., None])
+        first_half = np.where(idx < mid, residual, -np.inf).max(axis=-1)
+        second_half = np.where(inside & (idx >= mid), residual, -np.inf).max(axis=-1)
+        result[..., first:first + step] = (first_half + second_half) / 2
+    return result
@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+def map_segments(x, y, func, starts, ends, n_jobs=None, backend='process'):
+    """
+    Evaluate a batched segment function `func(x, y, starts, ends)` (e.g. :func:`._calc_msd_batch`) in parallel by
+    splitting the consecutive segments into `n_jobs` parts. The parts are put back together in order, and since each
+    segment is evaluated independently the result is identical to `func(x, y, starts, ends)`.
+
+    :param x: Longitudinal distance in meters.
+    :param y: Vertical displacement.
+    :param func: Batched segment function. It must be picklable for the '*process*' backend, i.e., a module level
+        function or a `functools.partial` of one.
+    :param starts: Start index of each segment.
+    :param ends: End index of each segment.
+    :param n_jobs: Number of workers. If `None` the number of CPUs is used.
+    :param backend: '*process*' uses a process pool where `x` and `y` are shared with the workers through shared memory
+        instead of being pickled, and '*thread*' uses a thread pool working directly on the arrays.
+    :return: Array of segment values.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    nparts = min(n_jobs, len(starts))
+    if nparts <= 1:
+        return func(x, y, starts, ends)
+    parts = np.array_split(np.arange(len(starts)), nparts)
+    plans = [(starts[part], ends[part]) for part in parts]
+
+    if backend == 'thread':
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(lambda plan: func(x, y, *plan), plans))
+    elif backend == 'process':
+        shared = []
+        try:
+            x_desc = _to_shared_memory(x, shared)
+            y_desc = _to_shared_memory(y, shared)
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(_shared_worker, x_desc, y_desc, func, *plan) for plan in plans]
+                results = [future.result() for future in futures]
+        finally:
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+    else:
+        raise Exception('backend "{}" not known.'.format(backend))
+    return np.concatenate(results, axis=-1)
+
+def _to_shared_memory(a, shared):
+    a = np.asarray(a)
+    shm = SharedMemory(create=True, size=max(a.nbytes, 1))
+    shared.append(shm)
+    np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+    return shm.name, a.shape, a.dtype.str
+
+def _from_shared_memory(desc):
+    name, shape, dtype = desc
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _shared_worker(x_desc, y_desc, func, starts, ends):
+    shm_x, x = _from_shared_memory(x_desc)
+    shm_y, y = _from_shared_memory(y_desc)
+    try:
+        return np.array(func(x, y, starts, ends))
+    finally:
+        del x, y
+        shm_x.close()
+        shm_y.close()
@@ -0,0 +1,237 @@
+from collections import deque
+import copy
+from functools import partial
+import numpy as np
+
+from .filtering import _iter_interpolate_dropouts, _mpd_butterworth_stream, _truncated_range, envelope
+from .mpd import iter_calculate_mpd
+from .tpa import iter_calculate_tpa
+from .texture import TEXTURE_METRICS, _calc_texture_batch, _segment_metrics, _texture_result
+from .utils import iter_each_evaluation_length_batched
+
+class Pipeline:
+    """
+    Lazy description of a processing chain for a profile, e.g.::
+
+        pipeline = Pipeline(x, y).interpolate_dropouts(-9999).butterworth(keep=True)
+        result = pipeline.texture(['mpd', 'etd'])
+
+    The stage methods only record the stage and return a new pipeline, nothing is computed until a result is asked for
+    by :meth:`mpd`, :meth:`tpa`, :meth:`texture` or :meth:`profile`. The stages are then run block by block, each
+    block of `blocksize` points passing through all the stages before the next block is read, so no full-length
+    intermediate profile is created. The envelope depends on the entire profile and is the only stage that collects
+    all blocks before passing them on.
+
+    Stages added with `keep=True` store their output, which is shared by all pipelines derived from the same
+    :class:`.Pipeline` object. Later runs start from the last stored stage, e.g., calculating MPD with other parameters
+    does not repeat the dropout interpolation and filtering.
+
+    :param x: Longitudinal distance in meters.
+    :param y: Vertical displacement in milimeters. Multiple channels are supported as in :func:`.calculate_mpd`
+        except by the envelope stage.
+    :param blocksize: Number of points in each block.
+    """
+    def __init__(self, x, y, blocksize=2**20):
+        self.x = x
+        self.y = y
+        self.blocksize = blocksize
+        self.stages = ()
+        self._cache = {}
+
+    def interpolate_dropouts(self, criteria, keep=False):
+        """
+        Add dropout interpolation as in :func:`.interpolate_dropouts`. A boolean `criteria` array is not supported.
+        """
+        return self._add_stage('interpolate_dropouts', (criteria,), keep)
+
+    def butterworth(self, sampling_rate=None, keep=False):
+        """
+        Add the Butterworth filtering of the '*butterworth*' MPD method (see :class:`.MPDButterworthFilter`). If
+        `sampling_rate` is `None` it is estimated as the mean distance between the points entering the stage, as by
+        :func:`.mpd_butterworth`, i.e., after the truncation by a preceding :meth:`interpolate_dropouts` stage.
+        """
+        return self._add_stage('butterworth', (sampling_rate,), keep)
+
+    def envelope(self, d=0, maxiter=100, keep=False):
+        """
+        Add enveloping as in :func:`.envelope`.
+        """
+        return self._add_stage('envelope', (d, maxiter), keep)
+
+    def _add_stage(self, name, params, keep):
+        pipeline = copy.copy(self) # The cache is shared
+        pipeline.stages = self.stages + ((name, params, keep),)
+        return pipeline
+
+    def clear_cache(self):
+        """
+        Remove all stored stage outputs.
+        """
+        self._cache.clear()
+
+    def blocks(self):
+        """
+        Run the stages lazily.
+
+        :return: Generator of the processed `(x, y)` blocks.
+        """
+        first = 0
+        blocks = None
+        for k in range(len(self.stages), 0, -1):
+            if self._key(k) in self._cache:
+                first = k
+                blocks = _iter_blocks(*self._cache[self._key(k)], self.blocksize)
+                break
+        if blocks is None:
+            blocks = _iter_blocks(self.x, self.y, self.blocksize)
+        for k in range(first, len(self.stages)):
+            name, _, keep = self.stages[k]
+            blocks = _STAGES[name](blocks, self.blocksize, *self._params(k))
+            if keep:
+                blocks = self._store(blocks, self._key(k + 1))
+        return blocks
+
+    def _stacked_blocks(self):
+        # Blocks of the input of the last stage stacked with its output along a new first axis. The last stage must
+        # give one output block of the same shape for each input block, as the Butterworth stage does.
+        nstages = len(self.stages)
+        name, _, keep = self.stages[-1]
+        input_key, output_key = self._key(nstages - 1), self._key(nstages)
+        if (nstages == 1 or input_key in self._cache) and output_key in self._cache:
+            x, y_in = (self.x, self.y) if nstages == 1 else self._cache[input_key]
+            _, y_out = self._cache[output_key]
+            for start in range(0, len(x), self.blocksize):
+                part = slice(start, start + self.blocksize)
+                yield x[part], np.stack((y_in[..., part], y_out[..., part]))
+            return
+        parent = copy.copy(self)
+        parent.stages = self.stages[:-1]
+        inputs = deque()
+
+        def remember(blocks):
+            for x, y in blocks:
+                inputs.append(y)
+                yield x, y
+        blocks = remember(parent.blocks())
+        if keep and nstages > 1:
+            # The input is stored as well, so later runs are served from the cache.
+            blocks = self._store(blocks, input_key)
+        blocks = _STAGES[name](blocks, self.blocksize, *self._params(nstages - 1))
+        if keep:
+            blocks = self._store(blocks, output_key)
+        for x, y in blocks:
+            yield x, np.stack((inputs.popleft(), y))
+
+    def _params(self, k):
+        # Parameters of the k'th stage with the sampling rate of a Butterworth stage estimated if not given. The
+        # points entering the stage are the pipeline input truncated by the dropout interpolation stages before it.
+        name, params, _ = self.stages[k]
+        if name != 'butterworth' or params[0] is not None:
+            return params
+        start, end = 0, len(self.x)
+        for name, params, _ in self.stages[:k]:
+            if name == 'interpolate_dropouts':
+                start, end = _truncated_range(self.x, self.y, params[0], start, end, self.blocksize)
+        return (np.mean(np.diff(self.x[start:end])),)
+
+    def _key(self, nstages):
+        return tuple((name, params) for name, params, _ in self.stages[:nstages])
+
+    def _store(self, blocks, key):
+        x_blocks, y_blocks = [], []
+        for x, y in blocks:
+            x_blocks.append(x)
+            y_blocks.append(y)
+            yield x, y
+        # Only stored once the stage has been run to the end.
+        self._cache[key] = _concatenate_blocks(x_blocks, y_blocks, np.shape(self.y)[:-1])
+
+    def profile(self):
+        """
+        Run the stages and return the processed profile `(x, y)`.
+        """
+        x_blocks, y_blocks = [], []
+        for x, y in self.blocks():
+            x_blocks.append(x)
+            y_blocks.append(y)
+        return _concatenate_blocks(x_blocks, y_blocks, np.shape(self.y)[:-1])
+
+    def mpd(self, method='slope', seglen=0.1, nmean=10):
+        """
+        Run the stages and calculate MPD as in :func:`.calculate_mpd`. Use the :meth:`butterworth` stage rather than
+        the '*butterworth*' method to have the filtered profile stored.
+        """
+        return _concatenate_results(iter_calculate_mpd(self.blocks(), method, seglen, nmean), np.shape(self.y)[:-1])
+
+    def tpa(self, threshold=50, nmean=10, seglen=0.1, method='exact'):
+        """
+        Run the stages and calculate TPA as in :func:`.calculate_tpa`.
+        """
+        return _concatenate_results(iter_calculate_tpa(self.blocks(), threshold, nmean, seglen, method),
+                np.shape(self.y)[:-1])
+
+    def texture(self, metrics=TEXTURE_METRICS, method='slope', seglen=0.1, nmean=10, threshold=50):
+        """
+        Run the stages and calculate texture metrics as in :func:`.calculate_texture`. The `method` is either
+        '*slope*' or '*no filtering*', use the :meth:`butterworth` stage for Butterworth filtering. If the
+        :meth:`butterworth` stage is the last stage, TPA is calculated from the profile entering it as by
+        :func:`.calculate_texture` with the '*butterworth*' method. Otherwise all metrics are calculated from the
+        output of the last stage.
+        """
+        metrics = tuple(metrics)
+        if method not in ('slope', 'no filtering'):
+            raise Exception('method "{}" not known.'.format(method))
+        segment_metrics = _segment_metrics(metrics)
+        stacked = 'tpa' in segment_metrics and bool(self.stages) and self.stages[-1][0] == 'butterworth'
+        func = partial(_calc_texture_batch, metrics=segment_metrics, threshold=threshold/100, method=method,
+                stacked=stacked)
+        channels = np.shape(self.y)[:-1]
+        x_interval, values = _concatenate_results(
+                iter_each_evaluation_length_batched(self._stacked_blocks() if stacked else self.blocks(), func, nmean,
+                    seglen),
+                (len(segment_metrics),) + channels)
+        return _texture_result(x_interval, values, metrics, segment_metrics, channels)
+
+
+def _iter_blocks(x, y, blocksize):
+    for start in range(0, len(x), blocksize):
+        yield x[start:start + blocksize], y[..., start:start + blocksize]
+
+def _concatenate_blocks(x_blocks, y_blocks, channels):
+    if not x_blocks:
+        return np.zeros((0,)), np.zeros(channels + (0,))
+    return np.concatenate(x_blocks), np.concatenate(y_blocks, axis=-1)
+
+def _concatenate_results(results, shape):
+    # Consecutive x_interval arrays share their end/start value.
+    x_intervals, values = [], []
+    for x_interval, value in results:
+        x_intervals.append(x_interval if not x_intervals else x_interval[1:])
+        values.append(value)
+    if not x_intervals:
+        return np.zeros((0,)), np.zeros(shape + (0,))
+    return np.concatenate(x_intervals), np.concatenate(values, axis=-1)
+
+def _stage_interpolate_dropouts(blocks, blocksize, criteria):
+    return _iter_interpolate_dropouts(blocks, criteria)
+
+def _stage_butterworth(blocks, blocksize, sampling_rate):
+    apply = _mpd_butterworth_stream(sampling_rate)
+    for x, y in blocks:
+        yield x, apply(x, y)
+
+def _stage_envelope(blocks, blocksize, d, maxiter):
+    x_blocks, y_blocks = [], []
+    for x, y in blocks:
+        x_blocks.append(x)
+        y_blocks.append(y)
+    if x_blocks:
+        x, y = _concatenate_blocks(x_blocks, y_blocks, ())
+        del x_blocks, y_blocks
+        yield from _iter_blocks(x, envelope(y, d, maxiter), blocksize)
+
+_STAGES = {
+        'interpolate_dropouts': _stage_interpolate_dropouts,
+        'butterworth': _stage_butterworth,
+        'envelope': _stage_envelope,
+        }
@@ -1,26 +1,143 @@
 import numpy as np
 
-def profile_info(meter, z):
-    mm = meter * 1000
-    dist_points = np.diff(mm)
-    monotone = 'NO'
-    if all(dist_points > 0):
-        monotone = 'YES'
-    coinciding_points = 'YES'
-    if all(dist_points != 0):
-        coinciding_points = 'NO'
-    mean_dist = np.mean(dist_points)
-    std_dist = np.std(dist_points)
-    largest_dist = max(dist_points)
-    smallest_dist = min(dist_points)
-
-    text = [
-        'Number of measurement points:\t {:2.2f} mio.'.format(len(meter)/1e6),
-        'Length of measured sections:\t {:2.2f} km'.format((meter[-1] - meter[0])/1000),
-        'Measurement increasing: {}'.format(monotone),
-        'Any measurements coinciding: {}'.format(coinciding_points),
-        'Mean distance between points:\t\t {:1.4f} mm (σ = {:1.4f} mm)'.format(mean_dist, std_dist),
-        'Largest distance between points:\t {:1.4f} mm'.format(largest_dist),
-        'Smallest distance between points:\t {:1.4f} mm'.format(smallest_dist),
-        ]
-    print('\n'.join(text))
+from .filtering import _create_dropouts_cond
+from .utils import _true_runs
+
+SPACING_BINS_MM = np.linspace(0, 5, 21) # Default histogram bins of the distance between points, 0.25 mm wide.
+
+def profile_info(meter, z, criteria=None):
+    """
+    Print an overview of the measurement points of a profile. See :func:`.profile_statistics` for the parameters.
+    """
+    print(profile_statistics(meter, z, criteria))
+
+def profile_statistics(meter, z=None, criteria=None, chunksize=2**22, bins=None):
+    """
+    Calculate statistics of the distance between measurement points in a single pass over the profile, `chunksize`
+    points at a time. Thus `meter` and `z` can be memory-mapped arrays that do not fit in memory.
+
+    :param meter: Longitudinal distance in meters.
+    :param z: Vertical displacement. Only used to count dropouts.
+    :param criteria: Dropout criteria as in :func:`.interpolate_dropouts`. If `None` dropouts are not counted.
+    :param chunksize: Number of points processed at a time.
+    :param bins: Bin edges in millimeters of the histogram of distances between points. Default is `SPACING_BINS_MM`.
+    :return: :class:`.ProfileStatistics`
+    """
+    def chunks():
+        for start in range(0, len(meter), chunksize):
+            yield meter[start:start + chunksize], None if z is None else z[start:start + chunksize]
+    return profile_statistics_chunked(chunks(), criteria, bins)
+
+def profile_statistics_chunked(chunks, criteria=None, bins=None):
+    """
+    Same as :func:`.profile_statistics` for a profile given as an iterable of consecutive `(meter, z)` chunks. `z` can
+    be `None` if dropouts are not counted.
+    """
+    stats = ProfileStatistics(SPACING_BINS_MM if bins is None else bins)
+    last = None
+    last_dropout = False
+    for meter, z in chunks:
+        if len(meter) == 0:
+            continue
+        if last is None:
+            stats.start = meter[0]
+            offset = 0
+        else:
+            meter = np.concatenate(([last], meter))
+            offset = stats.npoints - 1
+        stats.npoints = offset + len(meter)
+        last = meter[-1]
+        stats.end = last
+
+        dist = np.diff(meter) * 1000 # mm
+        stats._add_distances(dist)
+        decreasing = np.flatnonzero(dist < 0)
+        if len(decreasing):
+            stats.decreasing.append(decreasing + offset + 1)
+        coinciding = np.flatnonzero(dist == 0)
+        if len(coinciding):
+            stats.coinciding.append(coinciding + offset + 1)
+
+        if criteria is not None and z is not None:
+            starts, ends = _true_runs(_create_dropouts_cond(np.asarray(z), criteria))
+            stats.dropouts += int((ends - starts).sum())
+            stats.dropout_runs += len(starts)
+            if len(starts) and last_dropout and starts[0] == 0:
+                stats.dropout_runs -= 1 # Run continues from the previous chunk
+            last_dropout = len(ends) > 0 and ends[-1] == len(z)
+    if criteria is None:
+        stats.dropouts = stats.dropout_runs = None
+    stats.decreasing = np.concatenate(stats.decreasing) if stats.decreasing else np.zeros((0,), dtype=np.intp)
+    stats.coinciding = np.concatenate(stats.coinciding) if stats.coinciding else np.zeros((0,), dtype=np.intp)
+    return stats
+
+
+class ProfileStatistics:
+    """
+    Statistics of a profile as returned by :func:`.profile_statistics`. Distances are in millimeters except for the
+    `start` and `end` of the profile which are in meters. `str()` gives the same text report as :func:`.profile_info`.
+
+    :ivar npoints: Number of measurement points.
+    :ivar start: First longitudinal distance.
+    :ivar end: Last longitudinal distance.
+    :ivar mean_dist: Mean distance between neighbouring points.
+    :ivar std_dist: Standard deviation of the distance between neighbouring points.
+    :ivar largest_dist: Largest distance between neighbouring points.
+    :ivar smallest_dist: Smallest distance between neighbouring points.
+    :ivar decreasing: Indices `n` where `meter[n] < meter[n - 1]`.
+    :ivar coinciding: Indices `n` where `meter[n] == meter[n - 1]`.
+    :ivar histogram: `(counts, bin_edges)` of the distance between neighbouring points.
+    :ivar dropouts: Number of dropouts or `None` if not counted.
+    :ivar dropout_runs: Number of runs of consecutive dropouts or `None` if not counted.
+    """
+    def __init__(self, bins):
+        self.npoints = 0
+        self.start = self.end = np.nan
+        self.mean_dist = self.std_dist = np.nan
+        self.largest_dist = self.smallest_dist = np.nan
+        self.decreasing = []
+        self.coinciding = []
+        self.histogram = (np.zeros((len(bins) - 1,), dtype=np.int64), np.asarray(bins, dtype=float))
+        self.dropouts = 0
+        self.dropout_runs = 0
+        self._ndist = 0
+        self._m2 = 0.0
+
+    def _add_distances(self, dist):
+        if len(dist) == 0:
+            return
+        # Combine mean and variance with the previous chunks (Chan et al.)
+        n = len(dist)
+        mean = np.mean(dist)
+        m2 = np.sum((dist - mean)**2)
+        if self._ndist == 0:
+            self.mean_dist, self._m2 = mean, m2
+            self.largest_dist, self.smallest_dist = np.max(dist), np.min(dist)
+        else:
+            total = self._ndist + n
+            delta = mean - self.mean_dist
+            self.mean_dist = self.mean_dist + delta * n / total
+            self._m2 = self._m2 + m2 + delta**2 * self._ndist * n / total
+            self.largest_dist = max(self.largest_dist, np.max(dist))
+            self.smallest_dist = min(self.smallest_dist, np.min(dist))
+        self._ndist += n
+        self.std_dist = np.sqrt(self._m2 / self._ndist)
+        self.histogram[0][:] += np.histogram(dist, self.histogram[1])[0]
+
+    @property
+    def monotone(self):
+        return len(self.decreasing) == 0 and len(self.coinciding) == 0
+
+    def __str__(self):
+        text = [
+            'Number of measurement points:\t {:2.2f} mio.'.format(self.npoints/1e6),
+            'Length of measured sections:\t {:2.2f} km'.format((self.end - self.start)/1000),
+            'Measurement increasing: {}'.format('YES' if self.monotone else 'NO'),
+            'Any measurements coinciding: {}'.format('YES' if len(self.coinciding) else 'NO'),
+            'Mean distance between points:\t\t {:1.4f} mm (σ = {:1.4f} mm)'.format(self.mean_dist, self.std_dist),
+            'Largest distance between points:\t {:1.4f} mm'.format(self.largest_dist),
+            'Smallest distance between points:\t {:1.4f} mm'.format(self.smallest_dist),
+            ]
+        if self.dropouts is not None:
+            text.append('Number of dropouts:\t\t\t {} ({} runs)'.format(self.dropouts, self.dropout_runs))
+        return '\n'.join(text)
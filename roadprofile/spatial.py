@@ -0,0 +1,177 @@
+import json
+import os
+import numpy as np
+
+from .gps import GPSChainage, RAD_EARTH_METER, DEGREES2RADIANS
+
+SPATIAL_INDEX_FORMAT_VERSION = 1
+
+class SpatialIndex:
+    """
+    Grid index over the GPS fixes of a survey for finding the parts of a profile near a position.
+
+    The fixes are projected to meters with an equirectangular projection around the mean latitude of the survey, which
+    is accurate for the distances of a query, and bucketed in square cells of `cell_size` meters. The fixes are sorted
+    by cell, so the fixes of a cell are found by a binary search, and a query only computes distances to the fixes in
+    the cells it overlaps.
+
+    Queries return chainage ranges of the matching parts of the track. Each matching fix covers the track halfway to
+    its neighbouring fixes, and consecutive matching fixes are joined into one range. Use :func:`.index_ranges` to
+    get the corresponding points of a profile or :func:`.interval_ranges` for the MPD/TPA intervals.
+
+    :param wgs_N: Latitude of each GPS fix in degrees.
+    :param wgs_E: Longitude of each GPS fix in degrees.
+    :param chainage: Chainage in meters of each fix or a :class:`.GPSChainage`. If `None` it is computed as in
+        :class:`.GPSChainage`.
+    :param cell_size: Side length of the grid cells in meters, preferably about the typical query radius.
+    """
+    def __init__(self, wgs_N, wgs_E, chainage=None, cell_size=25.0):
+        self.wgs_N = np.asarray(wgs_N, dtype=float)
+        self.wgs_E = np.asarray(wgs_E, dtype=float)
+        if chainage is None:
+            chainage = GPSChainage(self.wgs_N, self.wgs_E)
+        self.chainage = np.asarray(chainage.chainage if isinstance(chainage, GPSChainage) else chainage, dtype=float)
+        self.cell_size = float(cell_size)
+        self.lat0 = float(np.mean(self.wgs_N)) if len(self.wgs_N) else 0.0
+        east, north = self._project(self.wgs_N, self.wgs_E)
+        self.origin = (float(east.min()), float(north.min())) if len(east) else (0.0, 0.0)
+        column, row = self._cell(east, north)
+        self.shape = (int(column.max()) + 1, int(row.max()) + 1) if len(east) else (0, 0)
+        keys = column * self.shape[1] + row
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.east, self.north = east[self.order], north[self.order]
+
+    def _project(self, wgs_N, wgs_E):
+        wgs_N, wgs_E = np.asarray(wgs_N, dtype=float), np.asarray(wgs_E, dtype=float)
+        east = RAD_EARTH_METER * np.cos(self.lat0 * DEGREES2RADIANS) * wgs_E * DEGREES2RADIANS
+        north = RAD_EARTH_METER * wgs_N * DEGREES2RADIANS
+        return east, north
+
+    def _cell(self, east, north):
+        column = np.floor((east - self.origin[0]) / self.cell_size).astype(np.int64)
+        row = np.floor((north - self.origin[1]) / self.cell_size).astype(np.int64)
+        return column, row
+
+    def _candidates(self, east_min, north_min, east_max, north_max):
+        # Positions in the sorted fixes of the fixes in all cells overlapping the box.
+        (column_min, column_max), (row_min, row_max) = self._cell(np.array([east_min, east_max]),
+                np.array([north_min, north_max]))
+        column_min, row_min = max(column_min, 0), max(row_min, 0)
+        column_max, row_max = min(column_max, self.shape[0] - 1), min(row_max, self.shape[1] - 1)
+        if column_min > column_max or row_min > row_max:
+            return np.zeros((0,), dtype=np.intp)
+        # The cells of a column are consecutive keys.
+        columns = np.arange(column_min, column_max + 1) * self.shape[1]
+        lower = np.searchsorted(self.keys, columns + row_min, side='left')
+        upper = np.searchsorted(self.keys, columns + row_max, side='right')
+        lengths = upper - lower
+        return np.arange(lengths.sum()) + np.repeat(lower - np.cumsum(lengths) + lengths, lengths)
+
+    def _ranges(self, fixes):
+        # Chainage ranges of runs of consecutive matching fixes, each fix covering the track halfway to its neighbours.
+        fixes = np.sort(fixes)
+        if len(fixes) == 0:
+            return np.zeros((0,)), np.zeros((0,))
+        breaks = np.flatnonzero(np.diff(fixes) > 1) + 1
+        first = fixes[np.concatenate(([0], breaks))]
+        last = fixes[np.concatenate((breaks - 1, [len(fixes) - 1]))]
+        chainage = self.chainage
+        starts = np.where(first > 0, (chainage[np.maximum(first - 1, 0)] + chainage[first]) / 2, chainage[first])
+        ends = np.where(last < len(chainage) - 1,
+                (chainage[np.minimum(last + 1, len(chainage) - 1)] + chainage[last]) / 2, chainage[last])
+        return starts, ends
+
+    def query_radius(self, wgs_N, wgs_E, radius):
+        """
+        Parts of the track within `radius` meters of a position.
+
+        :return: `(starts, ends)` arrays of chainage ranges.
+        """
+        east, north = self._project(wgs_N, wgs_E)
+        candidates = self._candidates(east - radius, north - radius, east + radius, north + radius)
+        inside = (self.east[candidates] - east)**2 + (self.north[candidates] - north)**2 <= radius**2
+        return self._ranges(self.order[candidates[inside]])
+
+    def query_bbox(self, wgs_N_min, wgs_E_min, wgs_N_max, wgs_E_max):
+        """
+        Parts of the track inside a bounding box of latitudes and longitudes.
+
+        :return: `(starts, ends)` arrays of chainage ranges.
+        """
+        (east_min, east_max), (north_min, north_max) = self._project([wgs_N_min, wgs_N_max], [wgs_E_min, wgs_E_max])
+        candidates = self._candidates(east_min, north_min, east_max, north_max)
+        east, north = self.east[candidates], self.north[candidates]
+        inside = (east >= east_min) & (east <= east_max) & (north >= north_min) & (north <= north_max)
+        return self._ranges(self.order[candidates[inside]])
+
+    def query_point(self, wgs_N, wgs_E):
+        """
+        The fix nearest to a position.
+
+        :return: `(fix, chainage, distance)` of the nearest fix with the distance in meters.
+        """
+        if len(self.keys) == 0:
+            raise Exception('The index is empty.')
+        east, north = self._project(wgs_N, wgs_E)
+        # Search growing squares of cells until the nearest fix found is closer than the edge of the square.
+        reach = self.cell_size
+        while True:
+            candidates = self._candidates(east - reach, north - reach, east + reach, north + reach)
+            if len(candidates):
+                distance = np.hypot(self.east[candidates] - east, self.north[candidates] - north)
+                nearest = np.argmin(distance)
+                if distance[nearest] <= reach or len(candidates) == len(self.keys):
+                    fix = self.order[candidates[nearest]]
+                    return int(fix), self.chainage[fix], float(distance[nearest])
+            reach *= 2
+
+    def save(self, path):
+        """
+        Save the index to the directory `path`, which is created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ('wgs_N', 'wgs_E', 'chainage', 'order', 'keys', 'east', 'north'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        meta = {'version': SPATIAL_INDEX_FORMAT_VERSION, 'cell_size': self.cell_size, 'lat0': self.lat0,
+                'origin': list(self.origin), 'shape': list(self.shape)}
+        with open(os.path.join(path, 'spatial.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        Load an index saved by :meth:`save`.
+        """
+        with open(os.path.join(path, 'spatial.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != SPATIAL_INDEX_FORMAT_VERSION:
+            raise Exception('spatial index version "{}" not known.'.format(meta['version']))
+        index = cls.__new__(cls)
+        index.cell_size = meta['cell_size']
+        index.lat0 = meta['lat0']
+        index.origin = tuple(meta['origin'])
+        index.shape = tuple(meta['shape'])
+        for name in ('wgs_N', 'wgs_E', 'chainage', 'order', 'keys', 'east', 'north'):
+            setattr(index, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        return index
+
+def index_ranges(x, starts, ends):
+    """
+    Index ranges of the points of a profile inside chainage ranges, e.g., returned by :class:`.SpatialIndex`.
+
+    :param x: Longitudinal distance (chainage) in meters of the profile.
+    :return: `(first, last)` index arrays such that `x[first[n]:last[n]]` are the points in the n'th range.
+    """
+    return np.searchsorted(x, starts, side='left'), np.searchsorted(x, ends, side='right')
+
+def interval_ranges(x_interval, starts, ends):
+    """
+    Ranges of the intervals `x_interval` (as returned by :func:`.calculate_mpd`) overlapping chainage ranges.
+
+    :return: `(first, last)` index arrays such that `mpd[first[n]:last[n]]` are the values of intervals overlapping
+        the n'th range.
+    """
+    first = np.maximum(np.searchsorted(x_interval, starts, side='right') - 1, 0)
+    last = np.minimum(np.searchsorted(x_interval, ends, side='left'), len(x_interval) - 1)
+    return first, np.maximum(last, first)
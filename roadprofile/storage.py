@@ -0,0 +1,188 @@
+import json
+import os
+import numpy as np
+
+PROFILE_FORMAT_VERSION = 1
+PROFILE_UNITS = {'x': 'm', 'y': 'mm'}
+
+# A profile is a directory holding
+#
+#   header.json  Format version, number of points and channels, data types, sampling rate, units and dropout criteria.
+#   x.bin        Longitudinal distances as raw little-endian floats.
+#   y.bin        Vertical displacements as raw little-endian floats, one row of all channels per point.
+#   chunks.bin   Chunk index: the distance of the first point of every chunk of `chunk_size` points as little-endian
+#                float64.
+
+def write_profile(path, x, y, sampling_rate=None, dropout_criteria=None, chunk_size=2**20, dtype='<f8', units=None):
+    """
+    Write a profile in the on-disk format read by :func:`.open_profile`. See :class:`.ProfileWriter` for the
+    parameters.
+    """
+    with ProfileWriter(path, np.shape(y)[:-1], sampling_rate, dropout_criteria, chunk_size, dtype, units) as writer:
+        writer.write(x, y)
+
+def open_profile(path, mode='r'):
+    """
+    Open a profile written by :class:`.ProfileWriter` or :func:`.write_profile`.
+
+    :param path: Directory of the profile.
+    :param mode: Mode used for the memory-maps, see `numpy.memmap`.
+    :return: :class:`.ProfileFile`
+    """
+    return ProfileFile(path, mode)
+
+
+class ProfileWriter:
+    """
+    Write a profile block by block to the directory `path` in the on-disk format read by :func:`.open_profile`. The
+    header is written when the writer is closed, e.g., at the end of a `with` statement.
+
+    :param path: Directory of the profile. It is created if it does not exist.
+    :param channels: Shape of the channels of `y`, `()` for a single profile or `(n_channels,)`.
+    :param sampling_rate: Distance between measurements in meters. If `None` the mean distance is stored.
+    :param dropout_criteria: Dropout criteria of the measurements (see :func:`.interpolate_dropouts`) or `None`.
+    :param chunk_size: Number of points per entry in the chunk index.
+    :param dtype: Data type of `y`. `x` is always stored as float64.
+    :param units: Units of `x` and `y`. Default is `PROFILE_UNITS`.
+    """
+    def __init__(self, path, channels=(), sampling_rate=None, dropout_criteria=None, chunk_size=2**20, dtype='<f8',
+            units=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.channels = tuple(channels)
+        self.sampling_rate = sampling_rate
+        self.dropout_criteria = dropout_criteria
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.units = dict(PROFILE_UNITS if units is None else units)
+        self.npoints = 0
+        self._first = self._last = None
+        self._chunk_starts = []
+        self._x_file = open(os.path.join(path, 'x.bin'), 'wb')
+        self._y_file = open(os.path.join(path, 'y.bin'), 'wb')
+
+    def write(self, x, y):
+        """
+        Append the next block of the profile.
+        """
+        x = np.asarray(x, dtype='<f8')
+        y = np.asarray(y)
+        if y.shape != self.channels + x.shape:
+            raise Exception('y of shape {} does not match channels {} and {} points.'.format(y.shape, self.channels, len(x)))
+        if len(x) == 0:
+            return
+        if (self._last is not None and x[0] < self._last) or np.any(x[1:] < x[:-1]):
+            raise Exception('x must be non-decreasing.')
+        # Index of the first point of each chunk starting within this block.
+        first_chunk = -(-self.npoints // self.chunk_size) * self.chunk_size
+        self._chunk_starts.append(x[first_chunk - self.npoints::self.chunk_size])
+        x.tofile(self._x_file)
+        np.moveaxis(y, -1, 0).astype(self.dtype, copy=False).tofile(self._y_file)
+        if self._first is None:
+            self._first = x[0]
+        self._last = x[-1]
+        self.npoints += len(x)
+
+    def close(self):
+        """
+        Write the header and the chunk index and close the files.
+        """
+        self._x_file.close()
+        self._y_file.close()
+        chunk_starts = np.concatenate(self._chunk_starts) if self._chunk_starts else np.zeros((0,))
+        chunk_starts.astype('<f8').tofile(os.path.join(self.path, 'chunks.bin'))
+        sampling_rate = self.sampling_rate
+        if sampling_rate is None and self.npoints > 1:
+            sampling_rate = (self._last - self._first) / (self.npoints - 1)
+        criteria = self.dropout_criteria
+        if criteria is not None:
+            criteria = 'nan' if np.isnan(criteria) else float(criteria) # NaN is not valid JSON
+        header = {
+                'version': PROFILE_FORMAT_VERSION,
+                'npoints': self.npoints,
+                'channels': list(self.channels),
+                'x_dtype': '<f8',
+                'y_dtype': self.dtype.str,
+                'chunk_size': self.chunk_size,
+                'sampling_rate': None if sampling_rate is None else float(sampling_rate),
+                'units': self.units,
+                'dropout_criteria': criteria,
+                }
+        with open(os.path.join(self.path, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ProfileFile:
+    """
+    Profile in the on-disk format, see :func:`.open_profile`. `x` and `y` are `numpy.memmap` arrays, so they can be
+    passed to any function of the package and only the parts used are read from disk.
+
+    :ivar x: Longitudinal distance in meters.
+    :ivar y: Vertical displacement with shape `channels + (npoints,)`.
+    :ivar header: The header as a dictionary.
+    :ivar sampling_rate: Distance between measurements in meters.
+    :ivar dropout_criteria: Dropout criteria or `None`.
+    :ivar units: Units of `x` and `y`.
+    :ivar chunk_starts: Distance of the first point of each chunk of `chunk_size` points.
+    """
+    def __init__(self, path, mode='r'):
+        with open(os.path.join(path, 'header.json')) as f:
+            self.header = header = json.load(f)
+        if header['version'] != PROFILE_FORMAT_VERSION:
+            raise Exception('profile version "{}" not known.'.format(header['version']))
+        self.path = path
+        npoints = header['npoints']
+        channels = tuple(header['channels'])
+        self.chunk_size = header['chunk_size']
+        self.sampling_rate = header['sampling_rate']
+        self.units = header['units']
+        criteria = header['dropout_criteria']
+        self.dropout_criteria = np.nan if criteria == 'nan' else criteria
+        self.x = _memmap(os.path.join(path, 'x.bin'), header['x_dtype'], mode, (npoints,))
+        y = _memmap(os.path.join(path, 'y.bin'), header['y_dtype'], mode, (npoints,) + channels)
+        self.y = np.moveaxis(y, 0, -1)
+        self.chunk_starts = np.fromfile(os.path.join(path, 'chunks.bin'), dtype='<f8')
+
+    def __len__(self):
+        return len(self.x)
+
+    def locate(self, value, side='left'):
+        """
+        Same as `numpy.searchsorted(x, value, side)` but only the chunk holding the position is read from disk.
+        """
+        chunk = max(np.searchsorted(self.chunk_starts, value, side=side) - 1, 0)
+        start = chunk * self.chunk_size
+        return start + int(np.searchsorted(self.x[start:start + self.chunk_size], value, side=side))
+
+    def range(self, x0=None, x1=None):
+        """
+        The part of the profile in `[x0, x1]`.
+
+        :return: `(x, y)` memory-mapped views.
+        """
+        start = 0 if x0 is None else self.locate(x0, 'left')
+        end = len(self.x) if x1 is None else self.locate(x1, 'right')
+        return self.x[start:end], self.y[..., start:end]
+
+    def chunks(self, x0=None, x1=None, chunk_size=None):
+        """
+        Iterate the part of the profile in `[x0, x1]` in blocks of `chunk_size` points (default is the chunk size of
+        the profile), e.g., for :func:`.iter_calculate_mpd` or :func:`.profile_statistics_chunked`.
+
+        :return: Generator of `(x, y)` arrays read from disk.
+        """
+        x, y = self.range(x0, x1)
+        chunk_size = self.chunk_size if chunk_size is None else chunk_size
+        for start in range(0, len(x), chunk_size):
+            yield np.array(x[start:start + chunk_size]), np.array(y[..., start:start + chunk_size])
+
+def _memmap(filename, dtype, mode, shape):
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype) # numpy cannot map empty files
+    return np.memmap(filename, dtype=dtype, mode=mode, shape=shape)
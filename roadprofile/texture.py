@@ -0,0 +1,136 @@
+from functools import partial
+import numpy as np
+
+from .utils import apply_each_evaluation_length_batched, _work_dtype, _segment_result
+from .filtering import mpd_butterworth
+from .mpd import _calc_msd_batch, _suppress_slope_batch
+from .tpa import _calc_tpa_batch
+
+TEXTURE_METRICS = ('mpd', 'tpa', 'rms', 'etd')
+
+def calculate_texture(x, y, metrics=TEXTURE_METRICS, method='slope', seglen=0.1, nmean=10, threshold=50, n_jobs=1,
+        backend='process', out=None, return_segments=False):
+    """
+    Calculate several texture metrics for each evaluation length in a single pass over the profile. The profile is
+    segmented once and the slope of each segment is suppressed once, after which all the requested metrics are computed
+    from the same segments.
+
+    The available metrics are
+
+    * '*mpd*' Mean profile depth as in :func:`.calculate_mpd`.
+    * '*tpa*' Texture penetration area as in :func:`.calculate_tpa` (with the '*exact*' method).
+    * '*rms*' Root mean square of the filtered profile of each segment (ISO 13473-2), averaged like MPD.
+    * '*etd*' Estimated texture depth `0.2 + 0.8 * MPD` in millimeters (ISO 13473-1).
+
+    :param x: Longitudinal distance in meters.
+    :param y: Vertical displacement in milimeters. Multiple channels are supported as in :func:`.calculate_mpd`.
+    :param metrics: Names of the metrics to calculate.
+    :param method: Filtering used for MPD and RMS, same as :func:`.calculate_mpd`. TPA is always calculated from the
+        unfiltered profile.
+    :param seglen: Same as :func:`.calculate_mpd`.
+    :param nmean: Same as :func:`.calculate_mpd`.
+    :param threshold: Same as :func:`.calculate_tpa`.
+    :param n_jobs: Same as :func:`.calculate_mpd`.
+    :param backend: Same as :func:`.calculate_mpd`.
+    :param out: Structured array of :func:`.texture_dtype` the result is written to, with one row per evaluation
+        length (see :func:`.evaluation_counts`). It is returned as the result.
+    :param return_segments: If `True` the metrics of every evaluation segment are returned as well.
+    :return: Structured array with one row per evaluation length and the fields `'start'` and `'end'` of the interval
+        followed by the requested metrics in the given order. For multiple channels each metric field has shape
+        `(n_channels,)`. If `return_segments` is set `(result, segments)` is returned, where `segments` is a structured
+        array as in :func:`.calculate_mpd` with the fields `'msd'`, `'tpa'` and `'rms'` of the requested metrics (MSD
+        for MPD and ETD).
+    """
+    metrics = tuple(metrics)
+    if method not in ('slope', 'butterworth', 'no filtering'):
+        raise Exception('method "{}" not known.'.format(method))
+    segment_metrics = _segment_metrics(metrics)
+    func = partial(_calc_texture_batch, metrics=segment_metrics, threshold=threshold/100, method=method)
+    if method == 'butterworth':
+        # The unfiltered profile is still needed for TPA, so both are passed on (and shared with the workers).
+        y = np.stack((y, mpd_butterworth(x, y)))
+    result = apply_each_evaluation_length_batched(x, y, func, nmean, seglen, n_jobs, backend,
+            return_segments=return_segments)
+    channels = np.shape(y)[1:-1] if method == 'butterworth' else np.shape(y)[:-1]
+    texture = _texture_result(result[0], result[1], metrics, segment_metrics, channels, out)
+    if return_segments:
+        starts, ends, values = result[2]
+        names = ['msd' if metric == 'mpd' else metric for metric in segment_metrics]
+        return texture, _segment_result(x, starts, ends, dict(zip(names, values)), nmean)
+    return texture
+
+def texture_dtype(metrics=TEXTURE_METRICS, channels=(), dtype=np.float64):
+    """
+    Data type of the result of :func:`.calculate_texture`, e.g., for allocating its `out` array.
+
+    :param metrics: Names of the metrics.
+    :param channels: `()` for a single profile or `(n_channels,)`.
+    :param dtype: Data type of the metrics, float32 for a float32 profile.
+    """
+    return np.dtype([('start', float), ('end', float)] + [(metric, dtype, tuple(channels)) for metric in metrics])
+
+def _segment_metrics(metrics):
+    # The metrics computed for each segment. ETD is derived from MPD after averaging.
+    for metric in metrics:
+        if metric not in TEXTURE_METRICS:
+            raise Exception('metric "{}" not known.'.format(metric))
+    return tuple(metric for metric in ('mpd', 'tpa', 'rms')
+            if metric in metrics or (metric == 'mpd' and 'etd' in metrics))
+
+def _texture_result(x_interval, values, metrics, segment_metrics, channels, out=None):
+    values = dict(zip(segment_metrics, values))
+    if 'etd' in metrics:
+        values['etd'] = 0.2 + 0.8 * values['mpd']
+    if out is None:
+        result = np.empty((len(x_interval) - 1,), dtype=texture_dtype(metrics, channels, values[metrics[0]].dtype))
+    elif out.shape != (len(x_interval) - 1,) or out.dtype.names != ('start', 'end') + metrics:
+        raise Exception('out does not match the result of {} rows with the fields {}.'.format(len(x_interval) - 1,
+                ('start', 'end') + metrics))
+    else:
+        result = out
+    result['start'] = x_interval[:-1]
+    result['end'] = x_interval[1:]
+    for metric in metrics:
+        result[metric] = np.moveaxis(values[metric], -1, 0)
+    return result
+
+def _calc_texture_batch(x, y, starts, ends, metrics, threshold, method, stacked=False):
+    """
+    Per segment values of `metrics` for the consecutive segments `x[starts[n]:ends[n]]`. For the '*butterworth*' method
+    or if `stacked` is set, `y` is the unfiltered and the (Butterworth) filtered profile stacked along the first axis.
+    TPA is then calculated from the unfiltered profile and the other metrics from the filtered profile. Returns an
+    array of shape `(len(metrics),) + channels + (len(starts),)`.
+    """
+    if method == 'butterworth' or stacked:
+        y_tpa, y = y
+    else:
+        y_tpa = y
+    if len(starts) == 0:
+        return np.zeros((len(metrics),) + np.shape(y)[:-1] + (0,))
+    first, last = starts[0], ends[-1]
+    xs, offsets, segment_ends = x[first:last], starts - first, ends - first
+    if method == 'slope':
+        ys = _suppress_slope_batch(x, y, starts, ends)
+    else:
+        ys = y[..., first:last]
+    results = []
+    for metric in metrics:
+        if metric == 'mpd':
+            results.append(_calc_msd_batch(xs, ys, offsets, segment_ends))
+        elif metric == 'rms':
+            results.append(_calc_rms_batch(ys, offsets, segment_ends))
+        elif metric == 'tpa':
+            results.append(_calc_tpa_batch(x, y_tpa, starts, ends, threshold))
+    return np.stack(results)
+
+def _calc_rms_batch(y, starts, ends):
+    """
+    RMS of `y[..., starts[n]:ends[n]]` about its mean for all consecutive segments at once.
+    """
+    lengths = ends - starts
+    counts = lengths.astype(_work_dtype(y))
+    y = y[..., starts[0]:ends[-1]]
+    offsets = starts - starts[0]
+    mean = np.add.reduceat(y, offsets, axis=-1) / counts
+    residual = y - np.repeat(mean, lengths, axis=-1)
+    return np.sqrt(np.add.reduceat(residual * residual, offsets, axis=-1) / counts)
@@ -2,32 +2,72 @@ from functools import partial
 import numpy as np
 from scipy.interpolate import interp1d
 
-from .utils import apply_each_evaluation_length_and_save_result
+from .utils import apply_each_evaluation_length_and_save_result, apply_each_evaluation_length_batched, iter_each_evaluation_length_batched, _apply_each_segment, _work_dtype, _segment_result
 
-def calculate_tpa(x, y, threshold=50, nmean=10, seglen=0.1):
+def calculate_tpa(x, y, threshold=50, nmean=10, seglen=0.1, method='exact', n_jobs=1, backend='process', out=None,
+        return_segments=False):
     """
     Calculate the Texture Penetration Area (TPA) as described in section 4.3 of [#f3]_.
 
 
     :param x: Longitudinal distance in meters.
-    :param y: Vertical displacement in milimeters.
+    :param y: Vertical displacement in milimeters. Multiple channels are supported as in :func:`.calculate_mpd`.
     :param threshold: Percentage of the (upper) profile curve that should be considered as peaks and thus integrated.
     :param seglen: Same as :func:`.calculate_mpd`.
     :param nmean: Same as :func:`.calculate_mpd`.
-    :return: `(x_interval, tpa)` where
+    :param str method: '*exact*' computes the threshold level and the area exactly from the piecewise linear profile
+        for all segments at once. '*interpolation*' approximates both by resampling each segment 50 times more densely.
+    :param n_jobs: Same as :func:`.calculate_mpd`.
+    :param backend: Same as :func:`.calculate_mpd`.
+    :param out: Same as :func:`.calculate_mpd`.
+    :param return_segments: If `True` the TPA of every evaluation segment is returned as well.
+    :return: `(x_interval, tpa)` or, if `return_segments` is set, `(x_interval, tpa, segments)` where
 
         * `x_interval` is an array with length `len(mpd) + 1` of start/end values of the consecutive intervals where TPA have been calculated.
         * `tpa` array of calculated TPA values.
+        * `segments` structured array as in :func:`.calculate_mpd` with the field `'tpa'` instead of `'msd'`.
 
     .. rubric:: Footnotes
     .. [#f3] http://forskning.ruc.dk/site/en/publications/id%287ea66167-850c-49ad-95a1-67bd4d8c4957.html
     """
-    _calc_tpa_core_fixed_thresh = partial(_calc_tpa_core, threshold=threshold/100)
-    x_list, tpa_list = apply_each_evaluation_length_and_save_result(x, y, _calc_tpa_core_fixed_thresh, nmean, seglen)
-    return np.array(x_list), np.array(tpa_list)
+    if method=='exact' or n_jobs != 1 or np.ndim(y) > 1:
+        result = apply_each_evaluation_length_batched(x, y, _tpa_batch_func(threshold, method), nmean, seglen, n_jobs,
+                backend, out, return_segments)
+    elif method=='interpolation':
+        _calc_tpa_core_fixed_thresh = partial(_calc_tpa_core, threshold=threshold/100)
+        result = apply_each_evaluation_length_and_save_result(x, y, _calc_tpa_core_fixed_thresh, nmean, seglen, out,
+                return_segments)
+    else:
+        raise Exception('method "{}" not known.'.format(method))
+    if return_segments:
+        x_interval, tpa, (starts, ends, values) = result
+        return x_interval, tpa, _segment_result(x, starts, ends, {'tpa': values}, nmean)
+    return result
+
+def iter_calculate_tpa(chunks, threshold=50, nmean=10, seglen=0.1, method='exact'):
+    """
+    Calculate TPA as in :func:`.calculate_tpa` for a profile given as an iterable of consecutive `(x, y)` chunks. See
+    :func:`.iter_calculate_mpd` for how segments crossing chunk borders are handled.
+
+    :param chunks: Iterable of `(x, y)` array pairs.
+    :param threshold: Same as :func:`.calculate_tpa`.
+    :param seglen: Same as :func:`.calculate_mpd`.
+    :param nmean: Same as :func:`.calculate_mpd`.
+    :param method: Same as :func:`.calculate_tpa`.
+    :return: Generator of `(x_interval, tpa)` as in :func:`.calculate_tpa` for the TPA values completed by each chunk.
+    """
+    return iter_each_evaluation_length_batched(chunks, _tpa_batch_func(threshold, method), nmean, seglen)
+
+def _tpa_batch_func(threshold, method):
+    if method=='exact':
+        return partial(_calc_tpa_batch, threshold=threshold/100)
+    elif method=='interpolation':
+        return partial(_apply_each_segment, func=partial(_calc_tpa_core, threshold=threshold/100))
+    else:
+        raise Exception('method "{}" not known.'.format(method))
 
 def _calc_tpa_core(xsub, ysub, threshold): # threshold refers to fraction of lowest data should be discarded
-    ysub += abs(min(ysub))
+    ysub = ysub + abs(min(ysub))
     f = interp1d(xsub, ysub, kind='linear')
     size = len(xsub) * 50 # how many interpolation points per data sample
     x_interp = np.linspace(xsub[0], xsub[-1], size)
@@ -38,3 +78,86 @@ def _calc_tpa_core(xsub, ysub, threshold): # threshold refers to fraction of low
     y_interp -= cutoff_length
     y_interp[y_interp < 0] = 0
     return np.trapz(y_interp, x_interp)
+
+def _calc_tpa_batch(x, y, starts, ends, threshold):
+    """
+    Exact version of :func:`._calc_tpa_core` for all consecutive segments `x[starts[n]:ends[n]]` at once.
+
+    The profile is linear between measurements, so the length of a segment above a level `c` is a piecewise linear,
+    decreasing function of `c` with breakpoints at the measured values. The level leaving `threshold` of the segment
+    length above it is found by a binary search over the sorted measured values of each segment followed by a linear
+    solve, and the area above it is integrated exactly.
+    """
+    if len(starts) == 0:
+        return np.zeros(np.shape(y)[:-1] + (0,))
+    first, last = starts[0], ends[-1]
+    # Integer profiles are processed as float64, e.g., the sorted segments are padded with infinity.
+    dtype = _work_dtype(y)
+    xs, ys = x[first:last], np.asarray(y[..., first:last], dtype=dtype)
+    nknots = ends - starts
+    offsets = starts - first
+    # Pieces are the line segments from each measurement to the next. The last piece of every segment (connecting it to
+    # the next segment or past the end) is given zero length, so each segment has as many pieces as measurements
+    # wherever it is in the batch, and the sums below do not depend on how the segments are split into batches.
+    dx = np.zeros((len(xs),), dtype=dtype)
+    dx[:-1] = np.diff(xs)
+    dx[offsets + nknots - 1] = 0
+    y0, y1 = ys, np.concatenate((ys[..., 1:], ys[..., -1:]), axis=-1)
+    lo, hi = np.minimum(y0, y1), np.maximum(y0, y1)
+    npieces = nknots
+    target = (threshold * (x[ends - 1] - x[starts])).astype(dtype, copy=False)
+
+    def length_above(level):
+        level = np.repeat(level, npieces, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.where(hi > lo, np.clip((hi - level) / (hi - lo), 0, 1), lo > level)
+        return np.add.reduceat(dx * frac, offsets, axis=-1)
+
+    sorted_values = _sort_each_segment(ys, offsets, nknots)
+
+    def sorted_value(rank):
+        return np.take_along_axis(sorted_values, offsets + rank, axis=-1)
+
+    # Smallest rank in each segment where the length above the value is at most the target length.
+    rank_lo = np.zeros(ys.shape[:-1] + (len(starts),), dtype=np.intp)
+    rank_hi = np.broadcast_to(nknots - 1, rank_lo.shape)
+    while np.any(rank_lo < rank_hi):
+        rank_mid = (rank_lo + rank_hi) // 2
+        below_target = length_above(sorted_value(rank_mid)) <= target
+        rank_hi = np.where(below_target, rank_mid, rank_hi)
+        rank_lo = np.where(below_target, rank_lo, rank_mid + 1)
+
+    # The level lies in (a, b] where the length above is linear on [a, b) and possibly jumps at b due to flat pieces.
+    b = sorted_value(rank_lo)
+    a = sorted_value(np.maximum(rank_lo - 1, 0))
+    length_a = length_above(a)
+    mid = (a + b) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (length_above(mid) - length_a) / (mid - a)
+        level = a + (target - length_a) / slope
+    level = np.where((rank_lo > 0) & (slope < 0) & (level < b), level, b)
+
+    level = np.repeat(level, npieces, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area = np.where(lo >= level, dx * ((y0 + y1) / 2 - level),
+                np.where(hi > level, dx * (hi - level)**2 / (2 * (hi - lo)), 0))
+    return np.add.reduceat(area, offsets, axis=-1)
+
+def _sort_each_segment(values, offsets, lengths):
+    """
+    Sort `values` (along the last axis) within each of the consecutive segments
+    `values[..., offsets[n]:offsets[n] + lengths[n]]`.
+    """
+    segment_id = np.repeat(np.arange(len(offsets)), lengths)
+    maxlen = lengths.max()
+    if len(offsets) * maxlen > 2 * values.shape[-1]:
+        # Very uneven segment lengths, avoid the padded array below.
+        if values.ndim > 1:
+            return np.array([_sort_each_segment(channel, offsets, lengths) for channel in values])
+        return values[np.lexsort((values, segment_id))]
+    # Sorting many short rows of a padded array is much faster than a lexsort of the entire profile.
+    column = np.arange(values.shape[-1]) - np.repeat(offsets, lengths)
+    padded = np.full(values.shape[:-1] + (len(offsets), maxlen), np.inf, dtype=values.dtype)
+    padded[..., segment_id, column] = values
+    padded.sort(axis=-1)
+    return padded[..., segment_id, column]
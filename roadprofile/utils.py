@@ -1,49 +1,375 @@
+from collections import OrderedDict, namedtuple
+import hashlib
+import threading
 import numpy as np
 
+from .parallel import map_segments
+
 _epsilon = np.finfo(np.float32).eps
 
-def apply_each_evaluation_length_and_save_result(x, y, func, nmean, seglen):
-    result_list = []
-    x_list = []
-
-    check = nmean - 1
-    value_array = np.zeros((nmean,))
-    x_list.append(x[0])
-    for n, (start, end) in enumerate(iter_intervals_by_length(x, seglen)):
-        xsub, ysub = x[start:end], y[start:end]
-        idx = n % nmean
-        value_array[idx] = func(xsub, ysub)
-        if idx == check:
-            x_list.append(xsub[-1])
-            result_list.append(np.mean(value_array))
-    return x_list, result_list
+def _work_dtype(y):
+    # Profiles in float32 are processed in float32 to halve the memory use, everything else in float64.
+    return np.dtype(np.float32) if np.asarray(y).dtype == np.float32 else np.dtype(np.float64)
 
-def iter_intervals_by_length(x, length=0.1):
+SegmentationCacheInfo = namedtuple('SegmentationCacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize', 'nbytes'])
+
+class SegmentationCache:
+    """
+    Least recently used cache of the segmentation plans of :func:`.segment_boundaries`. The plans are keyed on a
+    fingerprint of the contents of `x` and the segment length, so calculating several metrics or `nmean` variants
+    for the same profile only segments it once. The metric functions use the module level instance
+    `segmentation_cache`.
+
+    The cached `(starts, ends)` arrays are read-only since they are shared between calls.
+
+    :param maxsize: Maximum number of plans kept. If 0 nothing is cached.
+    :param maxbytes: Maximum total size in bytes of the plans kept.
+    """
+    def __init__(self, maxsize=32, maxbytes=2**28):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = self.misses = self.evictions = 0
+        self.nbytes = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def segment_boundaries(self, x, length=0.1):
+        """
+        Same as :func:`.segment_boundaries` but the plan is looked up in the cache first.
+        """
+        if self.maxsize == 0:
+            return segment_boundaries(x, length)
+        key = (_fingerprint(x), float(length))
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return plan
+            self.misses += 1
+        starts, ends = segment_boundaries(x, length)
+        starts.flags.writeable = ends.flags.writeable = False
+        nbytes = starts.nbytes + ends.nbytes
+        with self._lock:
+            if key not in self._plans and nbytes <= self.maxbytes:
+                self._plans[key] = starts, ends
+                self.nbytes += nbytes
+                while len(self._plans) > self.maxsize or self.nbytes > self.maxbytes:
+                    _, (old_starts, old_ends) = self._plans.popitem(last=False)
+                    self.nbytes -= old_starts.nbytes + old_ends.nbytes
+                    self.evictions += 1
+        return starts, ends
+
+    def info(self):
+        """
+        :return: `SegmentationCacheInfo(hits, misses, evictions, maxsize, currsize, nbytes)`.
+        """
+        with self._lock:
+            return SegmentationCacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._plans),
+                    self.nbytes)
+
+    def clear(self):
+        """
+        Remove all plans and reset the counters.
+        """
+        with self._lock:
+            self._plans.clear()
+            self.hits = self.misses = self.evictions = 0
+            self.nbytes = 0
+
+def _fingerprint(x):
+    x = np.ascontiguousarray(x)
+    return x.shape, x.dtype.str, hashlib.blake2b(x.view(np.uint8), digest_size=16).digest()
+
+segmentation_cache = SegmentationCache()
+
+def evaluation_counts(x, seglen=0.1, nmean=10):
+    """
+    Number of evaluation segments and evaluation lengths of a profile, e.g., for allocating the `out` arrays of
+    :func:`.calculate_mpd`, :func:`.calculate_tpa` and :func:`.calculate_texture`.
+
+    :param x: Longitudinal distance in meters.
+    :param seglen: Same as :func:`.calculate_mpd`.
+    :param nmean: Same as :func:`.calculate_mpd`.
+    :return: `(nsegments, nintervals)` where `nintervals` is the length of the results.
+    """
+    starts, _ = segmentation_cache.segment_boundaries(np.asarray(x), seglen)
+    return len(starts), len(starts) // nmean
+
+def apply_each_evaluation_length_and_save_result(x, y, func, nmean, seglen, out=None, return_segments=False):
+    starts, ends = segmentation_cache.segment_boundaries(x, seglen)
+    values = np.empty((len(starts),))
+    for n, (start, end) in enumerate(zip(starts, ends)):
+        values[n] = func(x[start:end], y[start:end])
+    return _evaluation_result(x, values, starts, ends, nmean, out, return_segments)
+
+def apply_each_evaluation_length_batched(x, y, func, nmean, seglen, n_jobs=1, backend='process', out=None,
+        return_segments=False):
+    starts, ends = segmentation_cache.segment_boundaries(x, seglen)
+    if n_jobs == 1:
+        values = func(x, y, starts, ends)
+    else:
+        values = map_segments(x, y, func, starts, ends, n_jobs, backend)
+    return _evaluation_result(x, values, starts, ends, nmean, out, return_segments)
+
+def _evaluation_result(x, values, starts, ends, nmean, out, return_segments):
+    # The segment values are kept for return_segments, they are computed either way.
+    x_interval, means = _mean_each_evaluation_length(x, values, ends, nmean, out)
+    if return_segments:
+        return x_interval, means, (starts, ends, values)
+    return x_interval, means
+
+def _segment_result(x, starts, ends, values, nmean):
+    """
+    Structured array with one row per evaluation segment and the fields `'start'` and `'end'` (the first and last
+    point of the segment), the segment values given by the dictionary `values` of `channels + (nsegments,)` arrays and
+    `'valid'`. A segment is valid if it is part of an evaluation length, i.e., not one of the segments after the last
+    complete group of `nmean`, and its values are finite.
+    """
+    x = np.asarray(x)
+    channels = next(iter(values.values())).shape[:-1]
+    dtype = ([('start', float), ('end', float)] + [(name, value.dtype, channels) for name, value in values.items()]
+            + [('valid', bool, channels)])
+    result = np.empty((len(starts),), dtype=dtype)
+    result['start'] = x[starts]
+    result['end'] = x[ends - 1]
+    valid = np.broadcast_to(np.arange(len(starts)) < len(starts) // nmean * nmean, channels + (len(starts),)).copy()
+    for name, value in values.items():
+        result[name] = np.moveaxis(value, -1, 0)
+        valid &= np.isfinite(value)
+    result['valid'] = np.moveaxis(valid, -1, 0)
+    return result
+
+def iter_each_evaluation_length_batched(chunks, func, nmean, seglen, prepare=None):
+    """
+    Streaming version of :func:`.apply_each_evaluation_length_batched` over an iterable of `(x, y)` chunks.
+
+    The points after the last complete segment of a chunk are carried over to the next chunk, as are the segment values
+    of an incomplete group of `nmean` segments. If given, `prepare(x, y)` is applied once to each new chunk before
+    segmentation (e.g. a stateful filter).
+
+    :return: Generator of `(x_interval, values)` for the groups completed by each chunk. Consecutive `x_interval` arrays
+        share their end/start value, i.e., concatenating the results gives the output of the in-memory function.
+    """
+    x_tail = y_tail = None
+    x_start = None
+    pending_values = pending_x_ends = None
+    for x, y in chunks:
+        x, y = np.asarray(x), np.asarray(y)
+        if len(x) == 0:
+            continue
+        if prepare is not None:
+            y = prepare(x, y)
+        if x_tail is not None:
+            x = np.concatenate((x_tail, x))
+            y = np.concatenate((y_tail, y), axis=-1)
+        if x_start is None:
+            x_start = x[0]
+        starts, ends = segment_boundaries(x, seglen)
+        tail = ends[-1] if len(ends) else 0
+        x_tail, y_tail = x[tail:], y[..., tail:]
+        if len(starts) == 0:
+            continue
+        values, x_ends = func(x, y, starts, ends), x[ends - 1]
+        if pending_values is not None:
+            values = np.concatenate((pending_values, values), axis=-1)
+            x_ends = np.concatenate((pending_x_ends, x_ends))
+        ngroups = values.shape[-1] // nmean
+        ncomplete = ngroups * nmean
+        pending_values, pending_x_ends = values[..., ncomplete:], x_ends[ncomplete:]
+        if ngroups == 0:
+            continue
+        x_interval = np.empty((ngroups + 1,))
+        x_interval[0] = x_start
+        x_interval[1:] = x_ends[nmean - 1:ncomplete:nmean]
+        x_start = x_interval[-1]
+        yield x_interval, values[..., :ncomplete].reshape(values.shape[:-1] + (ngroups, nmean)).mean(axis=-1)
+
+def _apply_each_segment(x, y, starts, ends, func):
+    if np.ndim(y) > 1:
+        return np.array([_apply_each_segment(x, channel, starts, ends, func) for channel in y])
+    return np.array([func(x[start:end], y[start:end]) for start, end in zip(starts.tolist(), ends.tolist())])
+
+def _mean_each_evaluation_length(x, values, ends, nmean, out=None):
+    ngroups = values.shape[-1] // nmean
+    x_interval = np.empty((ngroups + 1,))
+    x_interval[0] = x[0]
+    x_interval[1:] = x[ends[nmean - 1::nmean] - 1]
+    groups = values[..., :ngroups * nmean].reshape(values.shape[:-1] + (ngroups, nmean))
+    if out is None:
+        return x_interval, groups.mean(axis=-1)
+    if out.shape != groups.shape[:-1]:
+        raise Exception('out of shape {} does not match the result of shape {}.'.format(out.shape, groups.shape[:-1]))
+    return x_interval, np.mean(groups, axis=-1, out=out)
+
+def segment_boundaries(x, length=0.1):
+    """
+    Split the longitudinal distances `x` into consecutive evaluation segments.
+
+    Each segment is the least segment starting at the end of the previous one whose length is equal to or larger than
+    `length`. The segment ends are found in one vectorized search over all of `x` (see :func:`.iter_intervals_by_length`
+    for the equivalent generator).
+
+    :param x: Longitudinal distance in meters. Must be non-decreasing.
+    :param length: Length of the evaluation segments in meters.
+    :return: `(starts, ends)` integer arrays such that `x[starts[n]:ends[n]]` is the n'th segment.
+    """
     length = length - _epsilon # dirty fix because, e.g., 0.21 - 0.11 >= 0.1 is False
-    last_idx = 0
-    max_idx = len(x)
-    while last_idx < len(x) and (x[-1] - x[last_idx]) >= length:
-        indices = np.where(x[last_idx:max_idx] >= x[last_idx] + length)[0]
-        next_idx = min(indices) + 1
-        yield last_idx, last_idx + next_idx
-        max_idx = last_idx + (next_idx * 3) # NOTE 3 shold probably be adjustable
-        last_idx += next_idx
-        if len(x) <= max_idx:
-            max_idx = len(x)
+    n = len(x)
+    # next_start[i] is the start of the segment following a segment that starts at i.
+    next_start = np.searchsorted(x, np.asarray(x) + length, side='left') + 1
+    return _chain_segments(next_start, 0, n)
 
-def iter_intervals_by_true(cond):
-    idx = 0
-    count = 0
-    cond_idx = np.where(cond)[0]
-    while idx < len(cond_idx):
-        try:
-            consecutive = (cond_idx[idx + 1] - cond_idx[idx]) == 1
-        except IndexError:
-            yield cond_idx[idx - count], cond_idx[idx] + 1
+def _chain_segments(next_start, start, stop):
+    # Resolving the chain of segments from `start` only touches one integer per segment.
+    starts = []
+    get_next = next_start.item
+    while start < stop:
+        end = get_next(start)
+        if end > stop:
             break
-        if consecutive:
-            count += 1
-        else:
-            yield cond_idx[idx - count], cond_idx[idx] + 1
-            count = 0
-        idx += 1
+        starts.append(start)
+        start = end
+    starts = np.array(starts, dtype=np.intp)
+    return starts, np.asarray(next_start[starts]).astype(np.intp, copy=False)
+
+def sliding_segment_boundaries(x, length=0.1, stride=0.01):
+    """
+    Overlapping evaluation segments starting every `stride` meters. Each segment starts at the first point at or after
+    `x[0] + k * stride` and is the least segment of length equal to or larger than `length`, as in
+    :func:`.segment_boundaries`. Segments that would extend beyond `x` are left out.
+
+    :param x: Longitudinal distance in meters. Must be non-decreasing.
+    :param length: Length of the evaluation segments in meters.
+    :param stride: Distance in meters between the start of neighbouring segments.
+    :return: `(starts, ends)` integer arrays such that `x[starts[n]:ends[n]]` is the n'th segment.
+    """
+    n = len(x)
+    if n == 0:
+        return np.zeros((0,), dtype=np.intp), np.zeros((0,), dtype=np.intp)
+    grid = x[0] + stride * np.arange(int((x[-1] - x[0]) / stride) + 1)
+    starts = np.unique(np.searchsorted(x, grid - _epsilon, side='left')) # Several grid points in a gap of x
+    ends = np.searchsorted(x, x[starts] + (length - _epsilon), side='left') + 1
+    keep = ends <= n
+    return starts[keep].astype(np.intp, copy=False), ends[keep].astype(np.intp, copy=False)
+
+def iter_intervals_by_length(x, length=0.1):
+    starts, ends = segment_boundaries(x, length)
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield start, end
+
+def _range_max(values, lo, hi, blocksize=2**20):
+    """
+    Maximum of `values[..., lo[n]:hi[n]]` (along the last axis) for many non-empty ranges with non-decreasing `lo`.
+
+    A sparse table (see :func:`._max_table`) is built up to the longest range, so the total cost is
+    O(n log(range length)). The table is built for blocks of about `blocksize` points at a time to bound the memory use.
+    """
+    result = np.empty(values.shape[:-1] + (len(lo),), dtype=values.dtype)
+    if len(lo) == 0:
+        return result
+    lengths = hi - lo
+    # Group the ranges by the block their start falls in.
+    block_id = (lo - lo[0]) // blocksize
+    bounds = np.flatnonzero(np.diff(block_id)) + 1
+    for first, last in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(lo)]))):
+        offset = lo[first]
+        table = _max_table(values[..., offset:hi[first:last].max()], lengths[first:last].max())
+        result[..., first:last] = _query_max_table(table, lo[first:last] - offset, hi[first:last] - offset)
+    return result
+
+def _max_table(values, maxlength):
+    """
+    Sparse table of range maxima along the last axis of `values`, i.e., `table[k, i] = max(values[..., i:i + 2**k])`
+    for all `2**k <= maxlength`. The points are on the second axis followed by any leading axes of `values`.
+    Entries where the range extends beyond `values` hold the maximum of the part inside.
+    """
+    table = [np.moveaxis(values, -1, 0)]
+    for k in range(1, int(maxlength).bit_length()):
+        prev, width = table[-1], 2**(k - 1)
+        level = prev.copy()
+        np.maximum(prev[:-width], prev[width:], out=level[:-width])
+        table.append(level)
+    return np.stack(table)
+
+def _query_max_table(table, lo, hi):
+    # Every range is covered by the two (overlapping) table ranges of length 2**floor(log2(length)).
+    k = np.frexp(hi - lo)[1] - 1
+    return np.moveaxis(np.maximum(table[k, lo], table[k, hi - 2**k]), 0, -1)
+
+def _true_runs(cond):
+    """
+    Vectorized search for runs of consecutive `True` values in `cond`. Returns `(starts, ends)` index arrays such
+    that `cond[starts[n]:ends[n]]` is the n'th run.
+    """
+    cond = np.asarray(cond, dtype=bool)
+    if len(cond) == 0:
+        return np.zeros((0,), dtype=np.intp), np.zeros((0,), dtype=np.intp)
+    changes = np.flatnonzero(cond[1:] != cond[:-1]) + 1
+    if cond[0]:
+        changes = np.concatenate(([0], changes))
+    if cond[-1]:
+        changes = np.concatenate((changes, [len(cond)]))
+    changes = changes.astype(np.intp, copy=False)
+    return changes[0::2], changes[1::2]
+
+def _true_runs_2d(cond):
+    """
+    Same as :func:`._true_runs` for each row of a 2D array. Returns `(rows, starts, ends)`.
+    """
+    padded = np.zeros((cond.shape[0], cond.shape[1] + 2), dtype=bool)
+    padded[:, 1:-1] = cond
+    rows, changes = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    return rows[0::2], changes[0::2], changes[1::2]
+
+def find_runs(cond, stats=False, bins=None, segments=None):
+    """
+    Find all runs of consecutive `True` values in a boolean mask, e.g., dropouts (see :func:`.interpolate_dropouts`).
+
+    :param cond: Boolean mask.
+    :param stats: If `True` aggregate statistics of the runs are returned as well.
+    :param bins: Bins used for the histogram of run lengths, see `numpy.histogram`. If `None` the number of runs of each
+        length is counted, i.e., `histogram[0][k]` is the number of runs of length `k`.
+    :param segments: Optional `(starts, ends)` index arrays of ordered, non-overlapping segments, e.g., from
+        :func:`.segment_boundaries`, for which the fraction of masked values is computed.
+    :return: `(starts, ends, lengths)` or, if `stats` is set, `(starts, ends, lengths, statistics)` where
+
+        * `starts`, `ends` are index arrays such that `cond[starts[n]:ends[n]]` is the n'th run.
+        * `lengths` is the length of each run.
+        * `statistics` is a dictionary with the number of runs `'count'`, the total number of masked values
+          `'masked'`, the length `'longest'` of the longest run, the `'histogram'` of run lengths as
+          `(counts, bin_edges)` and, if `segments` is given, the `'segment_fraction'` masked of each segment.
+    """
+    starts, ends = _true_runs(cond)
+    lengths = ends - starts
+    if not stats:
+        return starts, ends, lengths
+    if bins is None:
+        counts = np.bincount(lengths)
+        histogram = (counts, np.arange(len(counts) + 1))
+    else:
+        histogram = np.histogram(lengths, bins)
+    statistics = {
+            'count': len(lengths),
+            'masked': int(lengths.sum()),
+            'longest': int(lengths.max()) if len(lengths) else 0,
+            'histogram': histogram,
+            'segment_fraction': None,
+            }
+    if segments is not None:
+        seg_starts, seg_ends = segments
+        masked = _masked_before(seg_ends, starts, ends, lengths) - _masked_before(seg_starts, starts, ends, lengths)
+        statistics['segment_fraction'] = masked / (seg_ends - seg_starts)
+    return starts, ends, lengths, statistics
+
+def _masked_before(idx, starts, ends, lengths):
+    # Number of masked values before each index in `idx` computed from the runs only.
+    cum_lengths = np.concatenate(([0], np.cumsum(lengths)))
+    nruns = np.searchsorted(starts, idx, side='left') # runs starting before idx
+    overshoot = np.where(nruns > 0, ends[np.maximum(nruns - 1, 0)] - idx, 0) if len(starts) else 0
+    return cum_lengths[nruns] - np.maximum(overshoot, 0)
+
+def iter_intervals_by_true(cond):
+    starts, ends = _true_runs(cond)
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield start, end
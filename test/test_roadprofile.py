@@ -1,9 +1,18 @@
 import unittest
+from unittest import mock
+from functools import partial
 import numpy as np
 import numpy.testing as npt
 
-from roadprofile import _calc_mpd_core, calculate_mpd, _calc_tpa_core, _create_dropouts_cond, iter_intervals_by_true, iter_intervals_by_length, interpolate_dropouts
-from roadprofile.gps import circum_circle_radius
+from roadprofile import _calc_mpd_core, calculate_mpd, mpd_butterworth_high, mpd_butterworth_low, _calc_tpa_core, _create_dropouts_cond, iter_intervals_by_true, iter_intervals_by_length, interpolate_dropouts, segment_boundaries, mpd_butterworth, iter_calculate_mpd, calculate_tpa, iter_calculate_tpa, ButterworthFilter, MPDButterworthFilter, envelope, envelope_windowed, find_runs, profile_statistics, calculate_texture, Pipeline, SegmentationCache, segmentation_cache, calculate_mpd_sliding, sliding_segment_boundaries, MPDIndex, write_profile, open_profile, ProfileWriter, read_text, ingest_text, evaluation_counts, texture_dtype
+from roadprofile.mpd import _calc_msd_batch, _calc_mpd_core_w_slopesupress
+from roadprofile.tpa import _calc_tpa_batch
+from roadprofile.utils import _epsilon, apply_each_evaluation_length_and_save_result
+from roadprofile.filtering import _truncated_range
+from roadprofile.pipeline import _STAGES
+from roadprofile.parallel import map_segments
+from roadprofile.gps import circum_circle_radius, calc_lengths, distance_on_unit_sphere, GPSChainage, calc_curvature_radi, iter_curvature_radius, STRAIGHT_RADIUS, RAD_EARTH_METER
+from roadprofile.spatial import SpatialIndex, index_ranges, interval_ranges
 
 class InterpolateDropoutsBaseTests:
     dropout_criteria = 999
@@ -66,6 +75,51 @@ class TestCreateDropoutsIndexHavingNaN(TestCreateDropoutsIndex):
         for start, end in iter_intervals_by_true(drop_outs):
             self.assertTrue(all(np.isnan(y[start:end])))
 
+class TestFindRuns(unittest.TestCase):
+    def test_runs(self):
+        cond = np.array([1, 1, 0, 0, 1, 0, 1, 1, 1], dtype=bool)
+        starts, ends, lengths = find_runs(cond)
+        npt.assert_array_equal(starts, [0, 4, 6])
+        npt.assert_array_equal(ends, [2, 5, 9])
+        npt.assert_array_equal(lengths, [2, 1, 3])
+        self.assertListEqual(list(iter_intervals_by_true(cond)), [(0, 2), (4, 5), (6, 9)])
+
+    def test_edge_cases(self):
+        for cond, expect in (([], []), ([0, 0], []), ([1], [(0, 1)]), ([0, 1, 0], [(1, 2)]), ([1, 1], [(0, 2)])):
+            starts, ends, _ = find_runs(np.array(cond, dtype=bool))
+            self.assertListEqual(list(zip(starts, ends)), expect)
+
+    def test_same_as_mask(self):
+        rng = np.random.RandomState(2)
+        cond = rng.uniform(size=1000) < 0.3
+        starts, ends, _ = find_runs(cond)
+        rebuilt = np.zeros(cond.shape, dtype=bool)
+        for start, end in zip(starts, ends):
+            rebuilt[start:end] = True
+        npt.assert_array_equal(cond, rebuilt)
+
+    def test_statistics(self):
+        cond = np.array([1, 1, 0, 0, 1, 0, 1, 1, 1, 0], dtype=bool)
+        segments = (np.array([0, 5]), np.array([5, 10]))
+        *_, statistics = find_runs(cond, stats=True, segments=segments)
+        self.assertEqual(statistics['count'], 3)
+        self.assertEqual(statistics['masked'], 6)
+        self.assertEqual(statistics['longest'], 3)
+        npt.assert_array_equal(statistics['histogram'][0], [0, 1, 1, 1])
+        npt.assert_array_almost_equal(statistics['segment_fraction'], [0.6, 0.6])
+        *_, statistics = find_runs(cond, stats=True, bins=[1, 2, 4])
+        npt.assert_array_equal(statistics['histogram'][0], [1, 2])
+
+    def test_segment_fraction_random(self):
+        rng = np.random.RandomState(8)
+        cond = rng.uniform(size=1000) < 0.4
+        seg_starts = np.arange(0, 1000, 70)
+        seg_ends = np.minimum(seg_starts + 50, 1000)
+        *_, statistics = find_runs(cond, stats=True, segments=(seg_starts, seg_ends))
+        expect = [cond[start:end].mean() for start, end in zip(seg_starts, seg_ends)]
+        npt.assert_array_almost_equal(statistics['segment_fraction'], expect)
+
+
 class TestInterpolateDropouts(unittest.TestCase, InterpolateDropoutsBaseTests):
     def execute_testprocedure(self, invalid_intervals):
         x = np.arange(1, 11)
@@ -131,6 +185,54 @@ class TestInterpolateDropouts(unittest.TestCase, InterpolateDropoutsBaseTests):
         npt.assert_almost_equal(y, y_org)
 
 
+class TestInterpolateDropoutsInPlace(unittest.TestCase):
+    def setUp(self):
+        self.x = np.arange(1, 15) * 1e-3
+        self.y_org = self.x * 1337 + 1.337
+        self.y = self.y_org.copy()
+        self.y[[0, 5, 8, 9, 10, 13]] = 999
+
+    def test_in_place(self):
+        y_out, truncated = interpolate_dropouts(self.x, self.y, 999, out=self.y)
+        self.assertTrue(np.shares_memory(y_out, self.y))
+        y_expect = self.y_org.copy()
+        y_expect[0], y_expect[13] = y_expect[1], y_expect[12]
+        npt.assert_almost_equal(self.y, y_expect)
+        self.assertEqual(truncated, (0, 14))
+
+    def test_out_array(self):
+        out = np.empty_like(self.y)
+        y_ref, _ = interpolate_dropouts(self.x, self.y, 999)
+        y_out, _ = interpolate_dropouts(self.x, self.y, 999, out=out)
+        self.assertTrue(np.shares_memory(y_out, out))
+        npt.assert_array_equal(y_ref, out)
+        self.assertEqual(self.y[5], 999)
+
+    def test_return_runs(self):
+        _, _, (starts, ends) = interpolate_dropouts(self.x, self.y, 999, return_runs=True)
+        npt.assert_array_equal(starts, [0, 5, 8, 13])
+        npt.assert_array_equal(ends, [1, 6, 11, 14])
+
+    def test_truncated_view(self):
+        x = np.arange(1, 15)
+        y_out, truncated = interpolate_dropouts(x, self.y, 999, out=self.y)
+        self.assertEqual(truncated, (0, 14))
+        self.y[:3] = 999
+        y_out, truncated = interpolate_dropouts(x, self.y, 999, out=self.y)
+        self.assertEqual(truncated, (3, 14))
+        self.assertTrue(np.shares_memory(y_out, self.y))
+
+    def test_mask_not_modified(self):
+        cond = self.y == 999
+        cond_org = cond.copy()
+        interpolate_dropouts(self.x, self.y, cond)
+        npt.assert_array_equal(cond, cond_org)
+
+    def test_all_invalid(self):
+        with self.assertRaises(Exception):
+            interpolate_dropouts(self.x, np.full(self.x.shape, 999.), 999)
+
+
 class TestAlwaysEqualOrStrictlyLargerThanLengthIntervals(unittest.TestCase):
     def _test_interval(self, data_in, test_out=None):
         data_in = np.array(data_in)
@@ -158,6 +260,42 @@ class TestAlwaysEqualOrStrictlyLargerThanLengthIntervals(unittest.TestCase):
                 [[0, 0.025, 0.075, 0.1], [0.11, 0.15, 0.18, 0.21]]
                 )
 
+class TestSegmentBoundaries(unittest.TestCase):
+    def reference_intervals(self, x, length=0.1):
+        # Segment search as done by the original generator, one segment at a time.
+        length = length - _epsilon
+        intervals = []
+        last_idx = 0
+        while last_idx < len(x) and (x[-1] - x[last_idx]) >= length:
+            next_idx = np.where(x[last_idx:] >= x[last_idx] + length)[0][0] + 1
+            intervals.append((last_idx, last_idx + next_idx))
+            last_idx += next_idx
+        return intervals
+
+    def test_same_as_reference_irregular_spacing(self):
+        rng = np.random.RandomState(1337)
+        x = np.cumsum(rng.uniform(0.0001, 0.01, size=5000))
+        starts, ends = segment_boundaries(x, 0.1)
+        self.assertListEqual(list(zip(starts, ends)), self.reference_intervals(x, 0.1))
+
+    def test_same_as_reference_regular_spacing(self):
+        x = np.arange(0, 2000) * 0.0005
+        starts, ends = segment_boundaries(x, 0.1)
+        self.assertListEqual(list(zip(starts, ends)), self.reference_intervals(x, 0.1))
+
+    def test_contiguous_integer_arrays(self):
+        x = np.arange(0, 1000) * 0.001
+        starts, ends = segment_boundaries(x, 0.1)
+        self.assertTrue(np.issubdtype(starts.dtype, np.integer))
+        npt.assert_array_equal(starts[1:], ends[:-1])
+
+    def test_empty_and_short_profiles(self):
+        for x in (np.array([]), np.array([0.]), np.array([0, 0.05])):
+            starts, ends = segment_boundaries(x, 0.1)
+            self.assertEqual(len(starts), 0)
+            self.assertEqual(len(ends), 0)
+
+
 class TestMPDAlgorithm(unittest.TestCase):
     def test__calc_mpd_core_include_50mm_point_in_first_interval(self):
         x = np.array([0, 0.025, 0.05, 0.075, 0.1])
@@ -204,6 +342,140 @@ class TestMPDAlgorithm(unittest.TestCase):
         npt.assert_array_almost_equal(np.array([2, 2]), mpd_out)
         npt.assert_array_almost_equal(x_out_expect, x_out)
 
+class TestSegmentationCache(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(16)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=5000))
+
+    def test_hits_and_misses(self):
+        cache = SegmentationCache()
+        starts, ends = cache.segment_boundaries(self.x, 0.1)
+        ref_starts, ref_ends = segment_boundaries(self.x, 0.1)
+        npt.assert_array_equal(starts, ref_starts)
+        npt.assert_array_equal(ends, ref_ends)
+        self.assertIs(cache.segment_boundaries(self.x.copy(), 0.1)[0], starts)
+        cache.segment_boundaries(self.x, 0.2)
+        x = self.x.copy()
+        x[-1] += 1
+        cache.segment_boundaries(x, 0.1)
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 3, 3))
+        with self.assertRaises(ValueError):
+            starts[0] = 1
+
+    def test_lru_eviction(self):
+        cache = SegmentationCache(maxsize=2)
+        for length in (0.1, 0.2, 0.1, 0.3, 0.1, 0.2):
+            cache.segment_boundaries(self.x, length)
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.evictions, info.currsize), (2, 4, 2, 2))
+        cache = SegmentationCache(maxbytes=0)
+        cache.segment_boundaries(self.x)
+        self.assertEqual(cache.info().currsize, 0)
+
+    def test_used_by_metrics(self):
+        segmentation_cache.clear()
+        y = np.sin(self.x * 1000)
+        calculate_mpd(self.x, y)
+        calculate_mpd(self.x, y, nmean=5)
+        calculate_tpa(self.x, y)
+        info = segmentation_cache.info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+
+class TestMSDBatch(unittest.TestCase):
+    def test_include_50mm_point_in_first_interval(self):
+        x = np.array([0, 0.025, 0.05, 0.075, 0.1, 0.11, 0.135, 0.161, 0.185, 0.21])
+        y = np.array([0, 0, 1, 0, 2, 0, 0, 1, 0, 2])
+        starts, ends = segment_boundaries(x, 0.1)
+        npt.assert_almost_equal([1.5, 1], _calc_msd_batch(x, y, starts, ends))
+
+    def test_same_as_per_segment_core(self):
+        rng = np.random.RandomState(42)
+        x = np.cumsum(rng.uniform(0.0002, 0.002, size=20000))
+        y = rng.normal(size=x.shape)
+        for method in ('no filtering', 'butterworth'):
+            x_out, mpd_out = calculate_mpd(x, y, method=method)
+            if method == 'butterworth':
+                y_ref = mpd_butterworth(x, y)
+            else:
+                y_ref = y
+            x_ref, mpd_ref = apply_each_evaluation_length_and_save_result(x, y_ref, _calc_mpd_core, 10, 0.1)
+            npt.assert_array_equal(x_ref, x_out)
+            npt.assert_array_equal(mpd_ref, mpd_out)
+
+    def test_slope_suppression_same_as_polyfit(self):
+        rng = np.random.RandomState(1337)
+        x = 1000 + np.cumsum(rng.uniform(0.0002, 0.002, size=20000))
+        y = rng.normal(size=x.shape) + 0.3 * x + 100
+        x_out, mpd_out = calculate_mpd(x, y, method='slope')
+        x_ref, mpd_ref = apply_each_evaluation_length_and_save_result(x, y, _calc_mpd_core_w_slopesupress, 10, 0.1)
+        npt.assert_array_equal(x_ref, x_out)
+        npt.assert_allclose(mpd_ref, mpd_out, rtol=1e-9)
+
+    def test_slope_suppression_removes_linear_trend(self):
+        x = np.linspace(0, 1, 1001)
+        y = np.tile([2, -2], 500).astype(float)
+        y = np.append(y, 2)
+        _, mpd_flat = calculate_mpd(x, y, method='slope')
+        _, mpd_sloped = calculate_mpd(x, y + 7 * x - 3, method='slope')
+        npt.assert_array_almost_equal(mpd_flat, mpd_sloped)
+
+
+class TestSlidingMPD(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(17)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=10000))
+        self.y = rng.normal(size=self.x.shape)
+        self.starts, self.ends = sliding_segment_boundaries(self.x, 0.1, 0.01)
+
+    def test_boundaries(self):
+        npt.assert_array_less(self.x[self.starts[:-1]] - _epsilon, self.x[0] + 0.01 * np.arange(1, len(self.starts)))
+        npt.assert_array_less(0.1 - _epsilon, self.x[self.ends - 1] - self.x[self.starts])
+        npt.assert_array_less(self.x[self.ends - 2] - self.x[self.starts], 0.1 - _epsilon)
+
+    def test_equal_to_each_segment(self):
+        segments = list(zip(self.starts, self.ends))
+        x_start, x_end, msd = calculate_mpd_sliding(self.x, self.y, method='no filtering')
+        npt.assert_array_equal(x_start, self.x[self.starts])
+        npt.assert_array_equal(x_end, self.x[self.ends - 1])
+        npt.assert_array_equal(msd, [_calc_mpd_core(self.x[s:e], self.y[s:e]) for s, e in segments])
+        _, _, msd = calculate_mpd_sliding(self.x, self.y, method='slope')
+        npt.assert_allclose(msd, [_calc_mpd_core_w_slopesupress(self.x[s:e], self.y[s:e]) for s, e in segments], rtol=1e-9)
+
+
+class TestMPDIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(18)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=30000))
+        self.y = rng.normal(size=self.x.shape)
+        self.index = MPDIndex(self.x, self.y)
+
+    def test_equal_to_calculate_mpd(self):
+        for x0, x1, nmean in ((0, self.x[-1], 10), (1.234, 20.5, 10), (3, 7.77, 1), (5, 5.01, 10)):
+            start, end = np.searchsorted(self.x, x0), np.searchsorted(self.x, x1, side='right')
+            x_ref, mpd_ref = calculate_mpd(self.x[start:end], self.y[start:end], method='no filtering', nmean=nmean)
+            x_out, mpd_out = self.index.mpd(x0, x1, nmean)
+            npt.assert_array_equal(x_out, x_ref)
+            npt.assert_array_equal(mpd_out, mpd_ref)
+
+    def test_butterworth(self):
+        index = MPDIndex(self.x, self.y, method='butterworth')
+        _, mpd_ref = calculate_mpd(self.x, self.y, method='butterworth')
+        npt.assert_allclose(index.mpd(self.x[0], self.x[-1])[1], mpd_ref, rtol=1e-12)
+        with self.assertRaises(Exception):
+            MPDIndex(self.x, self.y, method='slope')
+
+    def test_save_and_load(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as path:
+            self.index.save(path)
+            index = MPDIndex.load(path)
+            for result, expected in zip(index.msd(2, 11), self.index.msd(2, 11)):
+                npt.assert_array_equal(result, expected)
+            del index
+
+
 class TestTPACoreAlgorithm(unittest.TestCase):
     y = np.array([0, 1,   0, 1,   0, 1])
     x = np.array([0, 0.5, 1, 1.5, 2, 2.5])
@@ -230,6 +502,638 @@ class TestTPACoreAlgorithm(unittest.TestCase):
         for threshold in self.thresholds:
             npt.assert_almost_equal(_calc_tpa_core(self.x, y, threshold), 0, decimal=2)
 
+class TestButterworthFilter(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.sampling_rate = 0.0005
+        self.x = np.arange(20000) * self.sampling_rate
+        self.y = rng.normal(size=self.x.shape)
+
+    def test_same_as_transfer_function_form(self):
+        from scipy.signal import butter, lfilter
+        y_ref = self.y
+        for cutoff, btype in ((140/1000, 'highpass'), (3/1000, 'lowpass')):
+            a, b = butter(2, 2 / (cutoff / self.sampling_rate), btype=btype)
+            y_ref = lfilter(a, b, y_ref)
+        npt.assert_allclose(mpd_butterworth(self.x, self.y), y_ref, atol=1e-10)
+
+    def test_blockwise_same_as_one_call(self):
+        for fused in (True, False):
+            y_ref = MPDButterworthFilter(self.sampling_rate, fused=fused)(self.y)
+            f = MPDButterworthFilter(self.sampling_rate, fused=fused)
+            y_out = np.concatenate([f(block) for block in np.array_split(self.y, 13)])
+            npt.assert_array_equal(y_ref, y_out)
+
+    def test_fused_same_as_sequential(self):
+        y_fused = MPDButterworthFilter(self.sampling_rate, fused=True)(self.y)
+        y_sequential = MPDButterworthFilter(self.sampling_rate, fused=False)(self.y)
+        npt.assert_array_equal(y_fused, y_sequential)
+        y32 = self.y.astype(np.float32)
+        y_fused = MPDButterworthFilter(self.sampling_rate, fused=True)(y32)
+        y_sequential = MPDButterworthFilter(self.sampling_rate, fused=False)(y32)
+        npt.assert_allclose(y_fused, y_sequential, rtol=0, atol=1e-6 * np.abs(self.y).max())
+
+    def test_reset(self):
+        f = ButterworthFilter(2, 3/1000, self.sampling_rate, 'lowpass')
+        y_first = f(self.y)
+        f.reset()
+        npt.assert_array_equal(y_first, f(self.y))
+
+    def test_empty(self):
+        f = MPDButterworthFilter(self.sampling_rate)
+        y_ref = MPDButterworthFilter(self.sampling_rate)(self.y)
+        y_out = np.concatenate([f(self.y[:100]), f(np.zeros((0,))), f(self.y[100:])])
+        npt.assert_array_equal(y_ref, y_out)
+        self.assertEqual(mpd_butterworth_high(np.zeros((0,)), self.sampling_rate).shape, (0,))
+        self.assertEqual(mpd_butterworth_low(np.zeros((2, 0)), self.sampling_rate).shape, (2, 0))
+        self.assertEqual(mpd_butterworth(np.zeros((0,)), np.zeros((0,))).shape, (0,))
+
+    def test_design_is_cached(self):
+        f1 = ButterworthFilter(2, 3/1000, self.sampling_rate, 'lowpass')
+        f2 = ButterworthFilter(2, 3/1000, self.sampling_rate, 'lowpass')
+        self.assertIs(f1.sos, f2.sos)
+
+
+class TestEnvelope(unittest.TestCase):
+    def test_fast_same_as_reference(self):
+        rng = np.random.RandomState(11)
+        for _ in range(20):
+            z = np.cumsum(rng.normal(size=rng.randint(1, 300))) * rng.uniform(0.1, 3)
+            d, maxiter = rng.uniform(0.05, 2), rng.randint(1, 100)
+            npt.assert_array_equal(envelope(z, d, maxiter, method='reference'), envelope(z, d, maxiter))
+
+    def test_fast_same_as_reference_many_passes(self):
+        rng = np.random.RandomState(5)
+        x = np.arange(3000) * 0.0005
+        z = 2 * np.sin(300 * x) + 0.3 * rng.normal(size=x.shape)
+        z[rng.randint(0, len(z), 50)] -= 3
+        npt.assert_array_equal(envelope(z, 0.2, method='reference'), envelope(z, 0.2))
+
+    def test_input_not_modified(self):
+        z = np.array([0, 3, 0, -3, 0, 3, 0], dtype=float)
+        z_org = z.copy()
+        envelope(z, 0.5)
+        npt.assert_array_equal(z, z_org)
+
+    def test_zero_d_returns_copy(self):
+        z = np.array([0, 3, 0, -3, 0], dtype=float)
+        npt.assert_array_equal(envelope(z), z)
+
+
+class TestEnvelopeWindowed(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        x = np.arange(5000) * 0.0005
+        self.z = 2 * np.sin(300 * x) + 0.3 * rng.normal(size=x.shape)
+
+    def test_same_as_envelope_with_large_overlap(self):
+        z_out, windows = envelope_windowed(self.z, 0.5, window=1000, overlap=500)
+        npt.assert_array_equal(envelope(self.z, 0.5), z_out)
+        npt.assert_array_equal(windows['start'], np.arange(0, 5000, 1000))
+        npt.assert_array_equal(windows['end'], np.arange(1000, 5001, 1000))
+        self.assertTrue(all(windows['converged']))
+        self.assertTrue(all(windows['corrections'] > 0))
+
+    def test_maxiter_reached_is_flagged(self):
+        _, windows = envelope_windowed(self.z, 0.2, maxiter=3, window=1000, overlap=100)
+        self.assertFalse(any(windows['converged']))
+        npt.assert_array_equal(windows['passes'], 2)
+
+    def test_parallel_same_as_serial(self):
+        z_serial, windows_serial = envelope_windowed(self.z, 0.5, window=1000, overlap=100)
+        z_parallel, windows_parallel = envelope_windowed(self.z, 0.5, window=1000, overlap=100, n_jobs=2)
+        npt.assert_array_equal(z_serial, z_parallel)
+        npt.assert_array_equal(windows_serial, windows_parallel)
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=30000))
+        self.y = rng.normal(size=self.x.shape)
+        # Uneven chunk sizes, including chunks smaller than one evaluation segment.
+        self.borders = [0, 17, 60, 5000, 5000, 5003, 12345, 20000, 30000, 30000] # Including empty chunks
+
+    def chunks(self, y):
+        for start, end in zip(self.borders[:-1], self.borders[1:]):
+            yield self.x[start:end], y[start:end].copy()
+
+    def join(self, results):
+        x_interval = np.concatenate([results[0][0][:1]] + [x_out[1:] for x_out, _ in results])
+        return x_interval, np.concatenate([values for _, values in results])
+
+    def test_mpd_same_as_in_memory(self):
+        sampling_rate = np.mean(np.diff(self.x))
+        for method in ('slope', 'butterworth', 'no filtering'):
+            x_ref, mpd_ref = calculate_mpd(self.x, self.y, method=method)
+            x_out, mpd_out = self.join(list(iter_calculate_mpd(self.chunks(self.y), method=method, sampling_rate=sampling_rate)))
+            npt.assert_array_equal(x_ref, x_out)
+            npt.assert_array_equal(mpd_ref, mpd_out)
+
+    def test_leading_empty_chunk(self):
+        # The sampling rate is estimated from the first non-empty chunk.
+        chunks = [(self.x[:0], self.y[:0]), (self.x, self.y)]
+        x_ref, mpd_ref = calculate_mpd(self.x, self.y, method='butterworth')
+        x_out, mpd_out = self.join(list(iter_calculate_mpd(chunks, method='butterworth')))
+        npt.assert_array_equal(x_ref, x_out)
+        npt.assert_array_equal(mpd_ref, mpd_out)
+
+    def test_tpa_same_as_in_memory(self):
+        x_ref, tpa_ref = calculate_tpa(self.x, self.y.copy())
+        x_out, tpa_out = self.join(list(iter_calculate_tpa(self.chunks(self.y))))
+        npt.assert_array_equal(x_ref, x_out)
+        npt.assert_array_equal(tpa_ref, tpa_out)
+
+
+class TestTPAExact(unittest.TestCase):
+    y = np.array([0, 1,   0, 1,   0, 1])
+    x = np.array([0, 0.5, 1, 1.5, 2, 2.5])
+    tpa_val = 1.25
+    thresholds = [1, 0.5, 0.75, 0.25]
+
+    def calc_tpa(self, x, y, threshold):
+        return _calc_tpa_batch(x, y, np.array([0]), np.array([len(x)]), threshold)[0]
+
+    def test_different_thresholds(self):
+        for offset in (0, -0.5, -1, -2, 2):
+            for threshold in self.thresholds:
+                npt.assert_almost_equal(self.calc_tpa(self.x, self.y + offset, threshold), self.tpa_val * threshold**2)
+
+    def test_zero_profile(self):
+        for threshold in self.thresholds:
+            npt.assert_almost_equal(self.calc_tpa(self.x, np.zeros(self.y.shape), threshold), 0)
+
+    def test_flat_top(self):
+        # Half of the profile length is a plateau at 1, so any threshold up to 50% gives the area below the plateau.
+        x = np.array([0, 1, 2, 3, 4])
+        y = np.array([0, 1, 1, 1, 0.])
+        npt.assert_almost_equal(self.calc_tpa(x, y, 0.25), 0)
+        npt.assert_almost_equal(self.calc_tpa(x, y, 0.75), 2 * 0.5 + 2 * 0.5**2 / 2)
+
+    def test_batched_same_as_single_segments(self):
+        rng = np.random.RandomState(3)
+        x = np.cumsum(rng.uniform(0.0002, 0.002, size=5000))
+        y = rng.normal(size=x.shape)
+        starts, ends = segment_boundaries(x, 0.1)
+        tpa_batch = _calc_tpa_batch(x, y, starts, ends, 0.5)
+        tpa_single = [self.calc_tpa(x[start:end], y[start:end], 0.5) for start, end in zip(starts, ends)]
+        npt.assert_allclose(tpa_batch, tpa_single, rtol=1e-10)
+
+    def test_close_to_interpolation_and_input_not_modified(self):
+        rng = np.random.RandomState(4)
+        x = np.cumsum(rng.uniform(0.0002, 0.002, size=20000))
+        y = rng.normal(size=x.shape)
+        y_org = y.copy()
+        x_exact, tpa_exact = calculate_tpa(x, y)
+        npt.assert_array_equal(y, y_org)
+        x_interp, tpa_interp = calculate_tpa(x, y, method='interpolation')
+        npt.assert_array_equal(y, y_org)
+        npt.assert_array_equal(x_exact, x_interp)
+        npt.assert_allclose(tpa_exact, tpa_interp, rtol=1e-2)
+
+
+class TestProfileStorage(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        rng = np.random.RandomState(19)
+        self.x = np.cumsum(rng.uniform(0.0005, 0.0015, size=20000))
+        self.y = rng.normal(size=(2,) + self.x.shape)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_write_in_blocks_and_read(self):
+        with ProfileWriter(self.path, (2,), dropout_criteria=np.nan, chunk_size=1000) as writer:
+            for start in range(0, len(self.x), 3333):
+                writer.write(self.x[start:start + 3333], self.y[:, start:start + 3333])
+        profile = open_profile(self.path)
+        self.assertIsInstance(profile.x, np.memmap)
+        npt.assert_array_equal(profile.x, self.x)
+        npt.assert_array_equal(profile.y, self.y)
+        npt.assert_array_equal(profile.chunk_starts, self.x[::1000])
+        self.assertTrue(np.isnan(profile.dropout_criteria))
+        self.assertEqual(profile.units, {'x': 'm', 'y': 'mm'})
+        npt.assert_almost_equal(profile.sampling_rate, np.mean(np.diff(self.x)))
+        npt.assert_array_equal(calculate_mpd(profile.x, profile.y)[1], calculate_mpd(self.x, self.y)[1])
+        del profile
+
+    def test_range(self):
+        write_profile(self.path, self.x, self.y[0], dropout_criteria=-9999, chunk_size=1000, dtype='<f4')
+        profile = open_profile(self.path)
+        self.assertEqual(profile.dropout_criteria, -9999)
+        for x0, x1 in ((-1, 1), (self.x[1000], self.x[3000]), (5.5, 100)):
+            start, end = np.searchsorted(self.x, x0), np.searchsorted(self.x, x1, side='right')
+            x, y = profile.range(x0, x1)
+            npt.assert_array_equal(x, self.x[start:end])
+            npt.assert_array_equal(y, self.y[0, start:end].astype(np.float32))
+        x, y = zip(*profile.chunks(5, 10, chunk_size=777))
+        npt.assert_array_equal(np.concatenate(x), profile.range(5, 10)[0])
+        del profile, x, y
+
+    def test_decreasing_x(self):
+        with self.assertRaises(Exception):
+            write_profile(self.path, self.x[::-1], self.y[0])
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        rng = np.random.RandomState(20)
+        self.x = np.cumsum(rng.uniform(0.0005, 0.0015, size=5000))
+        self.y = rng.normal(size=(2,) + self.x.shape)
+        self.y[0, rng.rand(len(self.x)) < 0.05] = -9999
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'profile.csv')
+        with open(self.filename, 'w') as f:
+            f.write('x;y1;y2\n')
+            np.savetxt(f, np.column_stack((self.x, self.y[0], self.y[1])), delimiter=';', fmt='%.17g')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_text(self):
+        for blocksize in (100, 2**16):
+            x, y, dropouts = read_text(self.filename, ';', 1, 0, (1, 2), -9999, blocksize)
+            npt.assert_array_equal(x, self.x)
+            npt.assert_array_equal(y, self.y)
+            npt.assert_array_equal(dropouts, self.y == -9999)
+        x, y, dropouts = read_text(self.filename, ';', 1, 0, 2)
+        npt.assert_array_equal(y, self.y[1])
+        self.assertIsNone(dropouts)
+
+    def test_ingest_text(self):
+        import os
+        profile, dropouts = ingest_text(self.filename, os.path.join(self.directory.name, 'profile'), ';', 1, 0, (1, 2),
+                -9999, blocksize=2**12)
+        npt.assert_array_equal(profile.x, self.x)
+        npt.assert_array_equal(profile.y, self.y)
+        self.assertEqual(dropouts, np.count_nonzero(self.y == -9999))
+        self.assertEqual(profile.dropout_criteria, -9999)
+        del profile
+
+    def test_invalid_value(self):
+        with open(self.filename, 'w') as f:
+            f.write('0.001;1\n0.002;x\n')
+        with self.assertRaises(Exception):
+            read_text(self.filename, ';')
+
+
+class TestProfileStatistics(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(9)
+        self.meter = np.cumsum(rng.uniform(0.0002, 0.001, size=10000))
+        self.meter[[100, 5000]] = self.meter[[99, 4999]] # coinciding
+        self.meter[7000] = self.meter[6999] - 0.0001 # decreasing
+        self.z = rng.normal(size=self.meter.shape)
+        self.z[[10, 11, 12, 2047, 2048, 9999]] = -9999
+
+    def test_statistics(self):
+        stats = profile_statistics(self.meter, self.z, criteria=-9999)
+        dist = np.diff(self.meter) * 1000
+        self.assertEqual(stats.npoints, 10000)
+        npt.assert_almost_equal(stats.mean_dist, np.mean(dist))
+        npt.assert_almost_equal(stats.std_dist, np.std(dist))
+        npt.assert_almost_equal(stats.largest_dist, dist.max())
+        npt.assert_almost_equal(stats.smallest_dist, dist.min())
+        npt.assert_array_equal(stats.coinciding, [100, 5000])
+        npt.assert_array_equal(stats.decreasing, [7000])
+        self.assertFalse(stats.monotone)
+        self.assertEqual(stats.histogram[0].sum(), np.sum((dist >= 0) & (dist <= 5)))
+        self.assertEqual(stats.dropouts, 6)
+        self.assertEqual(stats.dropout_runs, 3)
+
+    def test_chunked_same_as_one_chunk(self):
+        stats = profile_statistics(self.meter, self.z, criteria=-9999)
+        for chunksize in (1, 7, 2048, 3333):
+            stats_chunked = profile_statistics(self.meter, self.z, criteria=-9999, chunksize=chunksize)
+            self.assertEqual(str(stats), str(stats_chunked))
+            npt.assert_array_equal(stats.coinciding, stats_chunked.coinciding)
+            npt.assert_array_equal(stats.decreasing, stats_chunked.decreasing)
+            npt.assert_array_equal(stats.histogram[0], stats_chunked.histogram[0])
+            npt.assert_almost_equal(stats.std_dist, stats_chunked.std_dist)
+
+    def test_report(self):
+        meter = np.array([0, 0.001, 0.002, 0.004])
+        text = str(profile_statistics(meter))
+        self.assertIn('Measurement increasing: YES', text)
+        self.assertIn('Any measurements coinciding: NO', text)
+        self.assertIn('Largest distance between points:\t 2.0000 mm', text)
+        self.assertNotIn('dropouts', text)
+
+
+class TestMultiChannel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(13)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=20000))
+        self.y = rng.normal(size=(3,) + self.x.shape)
+
+    def test_mpd_equal_to_each_channel(self):
+        for method in ('slope', 'butterworth', 'no filtering'):
+            x_out, mpd = calculate_mpd(self.x, self.y, method=method)
+            self.assertEqual(mpd.shape, (3, len(x_out) - 1))
+            for channel, y in zip(mpd, self.y):
+                x_ref, mpd_ref = calculate_mpd(self.x, y, method=method)
+                npt.assert_array_equal(x_ref, x_out)
+                npt.assert_allclose(channel, mpd_ref, rtol=1e-12)
+
+    def test_tpa_equal_to_each_channel(self):
+        for method in ('exact', 'interpolation'):
+            _, tpa = calculate_tpa(self.x, self.y, method=method)
+            for channel, y in zip(tpa, self.y):
+                npt.assert_allclose(channel, calculate_tpa(self.x, y, method=method)[1], rtol=1e-12)
+
+    def test_interpolate_dropouts(self):
+        y = self.y.copy()
+        y[0, :30] = y[1, :2] = y[1, 50:60] = y[2, -20:] = -9999
+        y_out, truncated, (channels, starts, ends) = interpolate_dropouts(self.x, y, -9999, return_runs=True)
+        self.assertEqual(truncated, (30, len(self.x) - 20))
+        npt.assert_array_equal(channels, [0, 1, 1, 2])
+        npt.assert_array_equal(starts, [0, 0, 50, len(self.x) - 20])
+        for channel, y_channel in zip(y_out, y):
+            y_ref, (start, end) = interpolate_dropouts(self.x, y_channel, -9999)
+            npt.assert_array_equal(channel, y_ref[truncated[0] - start:len(y_ref) - (end - truncated[1])])
+
+
+class TestTexture(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(14)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=20000))
+        self.y = rng.normal(size=self.x.shape)
+
+    def test_equal_to_single_metrics(self):
+        _, tpa = calculate_tpa(self.x, self.y)
+        for method in ('slope', 'butterworth', 'no filtering'):
+            result = calculate_texture(self.x, self.y, method=method)
+            self.assertEqual(result.dtype.names, ('start', 'end', 'mpd', 'tpa', 'rms', 'etd'))
+            x_ref, mpd = calculate_mpd(self.x, self.y, method=method)
+            npt.assert_array_equal(result['start'], x_ref[:-1])
+            npt.assert_array_equal(result['end'], x_ref[1:])
+            npt.assert_array_equal(result['mpd'], mpd)
+            npt.assert_array_equal(result['tpa'], tpa)
+            npt.assert_allclose(result['etd'], 0.2 + 0.8 * mpd)
+
+    def test_rms(self):
+        x = np.arange(1, 1001) * 1e-3
+        y = np.tile([1.0, -1.0], 500)
+        result = calculate_texture(x, y, metrics=['rms'], method='no filtering', nmean=2)
+        self.assertEqual(result.dtype.names, ('start', 'end', 'rms'))
+        npt.assert_allclose(result['rms'], np.ones(4), rtol=1e-3)
+
+    def test_unknown_metric(self):
+        with self.assertRaises(Exception):
+            calculate_texture(self.x, self.y, metrics=['mtd'])
+
+
+class TestSegmentResults(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(25)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=20000))
+        self.y = rng.normal(size=self.x.shape)
+
+    def test_mpd_segments(self):
+        starts, ends = segment_boundaries(self.x)
+        for method in ('slope', 'no filtering'):
+            x_interval, mpd, segments = calculate_mpd(self.x, self.y, method=method, return_segments=True)
+            x_ref, mpd_ref = calculate_mpd(self.x, self.y, method=method)
+            npt.assert_array_equal(x_interval, x_ref)
+            npt.assert_array_equal(mpd, mpd_ref)
+            npt.assert_array_equal(segments['start'], self.x[starts])
+            npt.assert_array_equal(segments['end'], self.x[ends - 1])
+            npt.assert_array_equal(segments['valid'], np.arange(len(starts)) < 10 * len(mpd))
+            npt.assert_allclose(segments['msd'][:10 * len(mpd)].reshape(-1, 10).mean(axis=-1), mpd)
+
+    def test_invalid_segments(self):
+        y = np.array([self.y, self.y])
+        y[1, 100:200] = np.nan
+        _, _, segments = calculate_mpd(self.x, y, method='no filtering', return_segments=True)
+        self.assertEqual(segments['msd'].shape, (len(segments), 2))
+        npt.assert_array_equal(segments['valid'][:, 1], segments['valid'][:, 0] & np.isfinite(segments['msd'][:, 1]))
+        self.assertFalse(segments['valid'][:, 1].all())
+
+    def test_out(self):
+        nsegments, nintervals = evaluation_counts(self.x)
+        self.assertEqual(nsegments, len(segment_boundaries(self.x)[0]))
+        out = np.empty((nintervals,))
+        _, mpd = calculate_mpd(self.x, self.y, out=out)
+        self.assertIs(mpd, out)
+        npt.assert_array_equal(out, calculate_mpd(self.x, self.y)[1])
+        out = np.empty((nintervals,))
+        _, tpa, segments = calculate_tpa(self.x, self.y, method='interpolation', out=out, return_segments=True)
+        self.assertIs(tpa, out)
+        npt.assert_allclose(segments['tpa'][:10 * nintervals].reshape(-1, 10).mean(axis=-1), tpa)
+        with self.assertRaises(Exception):
+            calculate_mpd(self.x, self.y, out=np.empty((nintervals + 1,)))
+
+    def test_texture(self):
+        _, nintervals = evaluation_counts(self.x)
+        out = np.empty((nintervals,), dtype=texture_dtype(('mpd', 'rms')))
+        result, segments = calculate_texture(self.x, self.y, metrics=('mpd', 'rms'), out=out, return_segments=True)
+        self.assertIs(result, out)
+        self.assertEqual(segments.dtype.names, ('start', 'end', 'msd', 'rms', 'valid'))
+        _, _, mpd_segments = calculate_mpd(self.x, self.y, return_segments=True)
+        npt.assert_array_equal(segments['msd'], mpd_segments['msd'])
+        with self.assertRaises(Exception):
+            calculate_texture(self.x, self.y, out=out)
+
+
+class TestFloat32(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(24)
+        self.x = 1000 + np.cumsum(rng.uniform(0.0002, 0.002, size=20000))
+        self.y = np.cumsum(rng.normal(scale=0.05, size=self.x.shape)) + rng.normal(size=self.x.shape)
+        self.y32 = self.y.astype(np.float32)
+        self.atol = 1e-6 * np.abs(self.y).max()
+
+    def test_mpd(self):
+        for method in ('slope', 'butterworth', 'no filtering'):
+            _, mpd = calculate_mpd(self.x, self.y, method=method)
+            _, mpd32 = calculate_mpd(self.x, self.y32, method=method)
+            self.assertEqual(mpd32.dtype, np.float32)
+            npt.assert_allclose(mpd32, mpd, rtol=0, atol=self.atol)
+        _, _, msd = calculate_mpd_sliding(self.x, self.y)
+        _, _, msd32 = calculate_mpd_sliding(self.x, self.y32)
+        self.assertEqual(msd32.dtype, np.float32)
+        npt.assert_allclose(msd32, msd, rtol=0, atol=self.atol)
+
+    def test_integer_tpa(self):
+        y = np.round(self.y * 100).astype(np.int32)
+        for threshold in (1, 50):
+            _, tpa = calculate_tpa(self.x, y.astype(np.float64), threshold=threshold)
+            _, tpa_int = calculate_tpa(self.x, y, threshold=threshold)
+            self.assertEqual(tpa_int.dtype, np.float64)
+            npt.assert_array_equal(tpa_int, tpa)
+
+    def test_tpa_and_texture(self):
+        _, tpa = calculate_tpa(self.x, self.y)
+        _, tpa32 = calculate_tpa(self.x, self.y32)
+        self.assertEqual(tpa32.dtype, np.float32)
+        npt.assert_allclose(tpa32, tpa, rtol=0, atol=self.atol)
+        result = calculate_texture(self.x, self.y)
+        result32 = calculate_texture(self.x, self.y32)
+        for metric in ('mpd', 'tpa', 'rms', 'etd'):
+            self.assertEqual(result32[metric].dtype, np.float32)
+            npt.assert_allclose(result32[metric], result[metric], rtol=0, atol=self.atol)
+
+    def test_filtering(self):
+        filtered32 = mpd_butterworth(self.x, self.y32)
+        self.assertEqual(filtered32.dtype, np.float32)
+        npt.assert_allclose(filtered32, mpd_butterworth(self.x, self.y), rtol=0, atol=self.atol)
+        y = self.y.copy()
+        y[::37] = np.nan
+        y_out, _ = interpolate_dropouts(self.x, y, np.nan)
+        y_out32, _ = interpolate_dropouts(self.x, y.astype(np.float32), np.nan)
+        self.assertEqual(y_out32.dtype, np.float32)
+        npt.assert_allclose(y_out32, y_out, rtol=0, atol=self.atol)
+        enveloped32 = envelope(self.y32[:2000])
+        self.assertEqual(enveloped32.dtype, np.float32)
+        npt.assert_allclose(enveloped32, envelope(self.y[:2000]), rtol=0, atol=self.atol)
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(15)
+        self.x = np.cumsum(rng.uniform(0.0005, 0.0015, size=30000))
+        self.y = rng.normal(size=self.x.shape)
+        self.y[rng.rand(len(self.y)) < 0.05] = -9999
+        self.y[:20] = -9999
+
+    def reference(self):
+        y, (start, end) = interpolate_dropouts(self.x, self.y, -9999)
+        return self.x[start:end], mpd_butterworth(self.x[start:end], y)
+
+    def test_equal_to_separate_calls(self):
+        x_ref, y_ref = self.reference()
+        pipeline = Pipeline(self.x, self.y, blocksize=1000).interpolate_dropouts(-9999).butterworth()
+        x_out, y_out = pipeline.profile()
+        npt.assert_array_equal(x_out, x_ref)
+        npt.assert_array_equal(y_out, y_ref)
+        for result, expected in zip(pipeline.mpd(method='no filtering'), calculate_mpd(x_ref, y_ref, method='no filtering')):
+            npt.assert_array_equal(result, expected)
+        result = pipeline.texture(['mpd', 'tpa'])
+        expected = calculate_texture(x_ref, y_ref, ['mpd', 'tpa'])
+        npt.assert_array_equal(result['mpd'], expected['mpd'])
+        # TPA is calculated from the unfiltered profile.
+        _, tpa = calculate_tpa(x_ref, interpolate_dropouts(self.x, self.y, -9999)[0])
+        npt.assert_allclose(result['tpa'], tpa, rtol=1e-12)
+        npt.assert_array_equal(pipeline.envelope(0.5).profile()[1], envelope(y_ref, 0.5))
+
+    def test_texture_butterworth(self):
+        y, (start, end) = interpolate_dropouts(self.x, self.y, -9999)
+        x = self.x[start:end]
+        expected = calculate_texture(x, y, method='butterworth')
+        pipeline = Pipeline(self.x, self.y, blocksize=1000).interpolate_dropouts(-9999)
+        pipeline = pipeline.butterworth(keep=True)
+        result = pipeline.texture(method='no filtering')
+        for metric in ('mpd', 'tpa', 'rms', 'etd'):
+            npt.assert_allclose(result[metric], expected[metric], rtol=1e-12)
+        # The input and the output of the Butterworth stage were stored by the texture run.
+        self.assertEqual(len(pipeline._cache), 2)
+        npt.assert_array_equal(pipeline.profile()[1], mpd_butterworth(x, y))
+
+    def test_texture_butterworth_cached(self):
+        calls = []
+
+        def counting(name, func):
+            def stage(*args):
+                calls.append(name)
+                return func(*args)
+            return stage
+        stages = {name: counting(name, func) for name, func in _STAGES.items()}
+        with mock.patch.dict('roadprofile.pipeline._STAGES', stages):
+            pipeline = Pipeline(self.x, self.y, blocksize=1000).interpolate_dropouts(-9999).butterworth(keep=True)
+            first = pipeline.texture(['mpd', 'tpa'], nmean=10)
+            second = pipeline.texture(['mpd', 'tpa'], nmean=5)
+            third = pipeline.texture(['mpd', 'tpa'], nmean=10)
+        self.assertEqual(calls, ['interpolate_dropouts', 'butterworth'])
+        npt.assert_array_equal(first, third)
+        uncached = Pipeline(self.x, self.y, blocksize=1000).interpolate_dropouts(-9999).butterworth()
+        npt.assert_array_equal(second, uncached.texture(['mpd', 'tpa'], nmean=5))
+
+    def test_interpolate_dropouts_blocks(self):
+        y_ref, (start, end) = interpolate_dropouts(self.x, self.y, -9999)
+        for blocksize in (1, 7, 100):
+            x_out, y_out = Pipeline(self.x, self.y, blocksize).interpolate_dropouts(-9999).profile()
+            npt.assert_array_equal(x_out, self.x[start:end])
+            npt.assert_array_equal(y_out, y_ref)
+
+    def test_long_dropouts(self):
+        # A run of dropouts longer than a block followed by the Butterworth stage.
+        y = self.y.copy()
+        y[10000:13000] = -9999
+        y_ref, (start, end) = interpolate_dropouts(self.x, y, -9999)
+        x_ref = self.x[start:end]
+        pipeline = Pipeline(self.x, y, blocksize=1000).interpolate_dropouts(-9999)
+        self.assertTrue(all(len(x) > 0 for x, _ in pipeline.blocks()))
+        pipeline = pipeline.butterworth()
+        x_out, y_out = pipeline.profile()
+        npt.assert_array_equal(x_out, x_ref)
+        npt.assert_array_equal(y_out, mpd_butterworth(x_ref, y_ref))
+        for result, expected in zip(pipeline.mpd(method='no filtering'), calculate_mpd(x_ref, y_ref, method='butterworth')):
+            npt.assert_array_equal(result, expected)
+
+    def test_truncated_range(self):
+        rng = np.random.RandomState(16)
+        for _ in range(50):
+            y = rng.normal(size=(2, 200))
+            for channel in range(2):
+                y[channel, :rng.randint(0, 30)] = -9999
+                y[channel, 200 - rng.randint(0, 30):] = -9999
+            for profile in (y[0], y):
+                _, expected = interpolate_dropouts(self.x[:200], profile, -9999)
+                for blocksize in (7, 1000):
+                    self.assertEqual(_truncated_range(self.x[:200], profile, -9999, blocksize=blocksize), expected)
+
+    def test_cached_stage_reused(self):
+        pipeline = Pipeline(self.x, self.y.copy(), blocksize=1000).interpolate_dropouts(-9999).butterworth(keep=True)
+        x_ref, mpd_ref = pipeline.mpd()
+        pipeline.y[:] = 0 # Only the stored output is used from now on
+        x_out, mpd_out = pipeline.mpd()
+        npt.assert_array_equal(x_out, x_ref)
+        npt.assert_array_equal(mpd_out, mpd_ref)
+        self.assertNotEqual(pipeline.mpd(nmean=5)[1][0], 0)
+        pipeline.clear_cache()
+        npt.assert_array_equal(pipeline.mpd()[1], np.zeros(mpd_ref.shape))
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(12)
+        self.x = np.cumsum(rng.uniform(0.0002, 0.002, size=30000))
+        self.y = rng.normal(size=self.x.shape)
+
+    def test_mpd_identical_to_serial(self):
+        for method in ('slope', 'butterworth', 'no filtering'):
+            x_ref, mpd_ref = calculate_mpd(self.x, self.y, method=method, nmean=7)
+            for backend in ('process', 'thread'):
+                x_out, mpd_out = calculate_mpd(self.x, self.y, method=method, nmean=7, n_jobs=3, backend=backend)
+                npt.assert_array_equal(x_ref, x_out)
+                npt.assert_array_equal(mpd_ref, mpd_out)
+
+    def test_tpa_identical_to_serial(self):
+        for method in ('exact', 'interpolation'):
+            x_ref, tpa_ref = calculate_tpa(self.x, self.y, method=method)
+            x_out, tpa_out = calculate_tpa(self.x, self.y, method=method, n_jobs=2)
+            npt.assert_array_equal(x_ref, x_out)
+            npt.assert_array_equal(tpa_ref, tpa_out)
+
+    def test_segments_identical_to_serial(self):
+        # Dense profiles with long segments, where a different summation order would show.
+        rng = np.random.RandomState(3)
+        x = np.arange(20000) * 0.0005
+        y = rng.normal(size=(2,) + x.shape)
+        starts, ends = segment_boundaries(x)
+        for nsegments in (7, 100, len(starts)):
+            for n_jobs in (2, 3, 4, 8):
+                for func in (_calc_msd_batch, partial(_calc_tpa_batch, threshold=0.5)):
+                    for profile in (y[0], y):
+                        reference = func(x, profile, starts[:nsegments], ends[:nsegments])
+                        result = map_segments(x, profile, func, starts[:nsegments], ends[:nsegments], n_jobs, 'thread')
+                        npt.assert_array_equal(reference, result)
+
+
 class TestGPS(unittest.TestCase):
     def test_curvature(self):
         from math import pi as PI
@@ -249,5 +1153,101 @@ class TestGPS(unittest.TestCase):
         output = circum_circle_radius(ab[:-1], ab[1:], c)
         npt.assert_array_almost_equal(output, np.ones(output.shape))
 
+    def test_curvature_chord(self):
+        # Circle with a radius of 500 m sampled every 0.1 m.
+        radius = 500
+        angle = np.arange(5000) * 0.1 / radius
+        meter_per_degree = RAD_EARTH_METER * np.pi / 180
+        wgs_N = 55.6 + radius * np.sin(angle) / meter_per_degree
+        wgs_E = 12.5 + radius * (1 - np.cos(angle)) / (meter_per_degree * np.cos(np.radians(55.6)))
+        output = calc_curvature_radi(wgs_N, wgs_E, method='chord')
+        npt.assert_allclose(output, radius, rtol=1e-3)
+        # Repeated fixes get the radius of the fix they repeat, also when read in chunks.
+        repeated = np.repeat(np.arange(len(wgs_N)), np.random.RandomState(23).randint(1, 4, len(wgs_N)))
+        for chunksize in (1, 2, 777):
+            chunks = ((wgs_N[repeated][n:n + chunksize], wgs_E[repeated][n:n + chunksize]) for n in range(0, len(repeated), chunksize))
+            npt.assert_array_equal(np.concatenate(list(iter_curvature_radius(chunks))), output[repeated])
+
+    def test_curvature_straight(self):
+        npt.assert_array_equal(calc_curvature_radi(np.linspace(55, 55.01, 10), np.full(10, 12.0), method='chord'), STRAIGHT_RADIUS)
+        npt.assert_array_equal(calc_curvature_radi(np.full(3, 55.0), np.full(3, 12.0), method='chord'), STRAIGHT_RADIUS)
+        npt.assert_array_equal(circum_circle_radius(np.array([1.0]), np.array([1.0]), np.array([2.0])), [STRAIGHT_RADIUS])
+
+    def test_chainage(self):
+        wgs_N = 55.6 + np.linspace(0, 0.01, 50)
+        wgs_E = 12.5 + 0.01 * np.sin(np.linspace(0, 3, 50))
+        track = GPSChainage(wgs_N, wgs_E, offset=100)
+        npt.assert_allclose(np.diff(track.chainage), calc_lengths(wgs_N, wgs_E), rtol=1e-4)
+        # Haversine formula, which is accurate for short distances.
+        lat, lon = np.radians(wgs_N), np.radians(wgs_E)
+        haversine = np.sin(np.diff(lat) / 2)**2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2)**2
+        npt.assert_allclose(np.diff(track.chainage), 2 * RAD_EARTH_METER * np.arcsin(np.sqrt(haversine)), rtol=1e-10)
+        positions = track.locate(track.chainage)
+        npt.assert_array_equal(positions['wgs_N'], wgs_N)
+        npt.assert_array_equal(positions['wgs_E'], wgs_E)
+        middle = track.locate((track.chainage[1:] + track.chainage[:-1]) / 2)
+        npt.assert_allclose(middle['wgs_N'], (wgs_N[1:] + wgs_N[:-1]) / 2)
+        outside = track.locate([0, 1e9])
+        npt.assert_array_equal(outside['wgs_E'], wgs_E[[0, -1]])
+        start, end, curvature = track.locate_intervals([100, 200, 300])
+        npt.assert_array_equal(start['chainage'], [100, 200])
+        npt.assert_array_equal(end['chainage'], [200, 300])
+        self.assertEqual(curvature.shape, (2,))
+
+    def test_chainage_close_fixes(self):
+        # Fixes 0.1 m apart along a meridian with repeated fixes.
+        steps = np.tile([0.1, 0.1, 0.0], 100)
+        wgs_N = 55.6 + np.concatenate(([0], np.cumsum(steps))) / RAD_EARTH_METER / (np.pi / 180)
+        wgs_E = np.full(wgs_N.shape, 12.5)
+        track = GPSChainage(wgs_N, wgs_E)
+        self.assertFalse(np.any(np.isnan(track.chainage)))
+        npt.assert_allclose(np.diff(track.chainage), steps, rtol=0, atol=1e-6)
+        self.assertEqual(track.chainage[3], track.chainage[2])
+
+class TestSpatialIndex(unittest.TestCase):
+    def setUp(self):
+        t = np.linspace(0, 1, 20000)
+        self.wgs_N = 55.6 + 0.03 * t + 0.001 * np.sin(40 * t)
+        self.wgs_E = 12.0 + 0.05 * np.sin(3 * t)
+        self.index = SpatialIndex(self.wgs_N, self.wgs_E, cell_size=20)
+        self.chainage = self.index.chainage
+
+    def test_radius_equal_to_brute_force(self):
+        for fix in (0, 5000, 12345, 19999):
+            wgs_N, wgs_E = self.wgs_N[fix] + 1e-4, self.wgs_E[fix] - 1e-4
+            starts, ends = self.index.query_radius(wgs_N, wgs_E, 25)
+            inside = np.flatnonzero(distance_on_unit_sphere(wgs_N, wgs_E, self.wgs_N, self.wgs_E) <= 25)
+            self.assertEqual(len(starts), 1)
+            self.assertLessEqual(starts[0], self.chainage[inside[0]])
+            self.assertGreaterEqual(ends[0], self.chainage[inside[-1]])
+            npt.assert_allclose([starts[0], ends[0]], self.chainage[[inside[0], inside[-1]]], atol=0.5)
+
+    def test_bbox_and_point(self):
+        starts, ends = self.index.query_bbox(55.61, 12.02, 55.62, 12.05)
+        inside = np.flatnonzero((self.wgs_N >= 55.61) & (self.wgs_N <= 55.62) & (self.wgs_E >= 12.02) & (self.wgs_E <= 12.05))
+        npt.assert_allclose([starts[0], ends[-1]], self.chainage[[inside[0], inside[-1]]], atol=0.5)
+        wgs_N, wgs_E = self.wgs_N[777] + 1e-5, self.wgs_E[777]
+        fix, chainage, distance = self.index.query_point(wgs_N, wgs_E)
+        distances = distance_on_unit_sphere(wgs_N, wgs_E, self.wgs_N, self.wgs_E)
+        self.assertEqual(fix, np.nanargmin(distances))
+        self.assertEqual(chainage, self.chainage[fix])
+        npt.assert_allclose(distance, np.nanmin(distances), atol=0.01)
+        self.assertEqual(self.index.query_point(10, 10)[0], 0)
+
+    def test_ranges_and_save(self):
+        import tempfile
+        starts, ends = self.index.query_radius(self.wgs_N[5000], self.wgs_E[5000], 10)
+        x_interval = np.arange(0, self.chainage[-1], 1.0)
+        first, last = interval_ranges(x_interval, starts, ends)
+        self.assertLessEqual(x_interval[first[0]], starts[0])
+        self.assertGreaterEqual(x_interval[last[0]], ends[0])
+        first, last = index_ranges(x_interval, starts, ends)
+        self.assertTrue(np.all(x_interval[first[0]:last[0]] >= starts[0]))
+        with tempfile.TemporaryDirectory() as path:
+            self.index.save(path)
+            for result, expected in zip(SpatialIndex.load(path).query_radius(self.wgs_N[5000], self.wgs_E[5000], 10), (starts, ends)):
+                npt.assert_array_equal(result, expected)
+
+
 if __name__ == '__main__':
     unittest.main()